@@ -0,0 +1,55 @@
+#!/usr/bin/python
+"""Measures the startup time of image-backup for commands that should return at once"""
+
+import os
+import os.path as path
+import sys
+import optparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+SCRIPT = path.join(path.dirname(path.dirname(path.abspath(__file__))),"image-backup-1.9.py")
+
+def timeCommand(args,runs):
+	"""Returns the sorted wall clock times in milliseconds of running args runs times"""
+	times = []
+	devnull = open(os.devnull,"w")
+	for i in range(runs):
+		start = time.time()
+		subprocess.call(args,stdout=devnull,stderr=devnull,stdin=devnull)
+		times.append((time.time()-start)*1000)
+	devnull.close()
+	times.sort()
+	return times
+
+def main():
+	parser = optparse.OptionParser(usage="usage: %prog [options]")
+	parser.add_option("-n","--runs",type="int",default=20,help="Number of runs per command. Default is [20]")
+	parser.add_option("--budget",type="float",default=None,metavar="MS",help="Fail if the median time of a command exceeds MS milliseconds")
+	parser.add_option("--python",default=sys.executable,help="Python interpreter used to run image-backup")
+	parser.add_option("--script",default=SCRIPT,help="Script to measure. Default is [%default]")
+	(options,args) = parser.parse_args(sys.argv[1:])
+
+	destination = tempfile.mkdtemp(prefix="imagebackup-bench")
+	try:
+		catalog = open(path.join(destination,"backup.info"),"w")
+		print >> catalog, "%version=1.9"
+		catalog.close()
+		commands = [	("--version",[options.python,options.script,"--version"]),
+							("--statistics",[options.python,options.script,"--statistics",destination])]
+		failed = False
+		for name,args in commands:
+			times = timeCommand(args,options.runs)
+			median = times[len(times)/2]
+			status = ""
+			if options.budget != None and median > options.budget:
+				status = "  over budget (%.1f ms)" % options.budget
+				failed = True
+			print "%-14s best %7.1f ms  median %7.1f ms%s" % (name,times[0],median,status)
+	finally:
+		shutil.rmtree(destination,True)
+	if failed: sys.exit(1)
+
+if __name__ == "__main__": main()
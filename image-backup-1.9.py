@@ -3,17 +3,17 @@
 import os
 import os.path as path
 import sys
+import stat
 import optparse
-import shutil
 import re
 import time
-import fcntl, fcntl, select
-import subprocess
-from tempfile import NamedTemporaryFile
-import commands
-import urllib
-from xdg.Mime import get_type as mime_type
+import io
+import fcntl
 from datetime import datetime
+try:
+	from scandir import scandir
+except ImportError:
+	scandir = None
 
 
 VERSION="1.9"
@@ -32,10 +32,743 @@ FIELDS = {	"1.0" : ["hash","filename","filesize","backupset","stored_to_external
 				}
 
 IMAGES = re.compile(r"\.jpg$|\.cr2$|\.jpeg$|\.tiff$|\.tif$|\.avi$|\.mov",re.IGNORECASE)
+MEDIA_TYPES = ("image","video")
+AMBIGUOUS_TYPES = ("application/octet-stream",)
+RAW_HASH = re.compile(r"^[0-9a-fA-F]{32}$")
 PROGRESS_PATTERN=re.compile(r"(\d+\.\d{2})%")
 RANGE_FILENAME = re.compile(r"(?P<year>\d{4})((?P<month>\d{2})((?P<day>\d{2})((_|-)(?P<hour>\d{2})((?P<minute>\d{2})((?P<second>\d{2}))?)?)?)?)?")
 RANGE = re.compile(r"((?P<year>\d{4})(:(?P<month>\d{1,2})(:(?P<day>\d{1,2})(:(?P<hour>\d{1,2})(:(?P<minute>\d{1,2}))?)?)?)?)-((?P<year2>\d{4})(:(?P<month2>\d{1,2})(:(?P<day2>\d{1,2})(:(?P<hour2>\d{1,2})(:(?P<minute2>\d{1,2}))?)?)?)?)")
 CONTINUEERRORS = (1,)
+HASH_BUFFER_SIZE = 1024*1024
+HASH_QUEUE_DEPTH = 8
+COPY_MAX_INFLIGHT = 256*1024*1024
+COPY_CHUNK_SIZE = 1024*1024*1024
+FICLONE = 0x40049409
+POSIX_FADV_DONTNEED = 4
+HASH_CACHE_BATCH = 1000
+HASH_CACHE_MAX_AGE = 90
+SAMPLE_SIZE = 64*1024
+SQLITE_BATCH = 10000
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, hash TEXT, filename TEXT, filesize INTEGER, backupset TEXT, stored_to_external INTEGER, media_title TEXT);
+CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);
+CREATE INDEX IF NOT EXISTS entries_filename ON entries (filename);
+CREATE INDEX IF NOT EXISTS entries_filesize ON entries (filesize);
+CREATE INDEX IF NOT EXISTS entries_backupset ON entries (backupset);
+CREATE INDEX IF NOT EXISTS entries_media_title ON entries (media_title);
+CREATE INDEX IF NOT EXISTS entries_stored_to_external ON entries (stored_to_external);
+"""
+SAMPLE_MIN_SIZE = 16*SAMPLE_SIZE
+CATALOG_BLOCK_SIZE = 4*1024*1024
+CATALOG_INDEX_MAGIC = "IBIDX001"
+JOURNAL_BATCH = 1000
+JOURNAL_CHECKPOINT_INTERVAL = 5
+JOURNAL_COMPACT_SIZE = 16*1024*1024
+
+class Hasher:
+	"""Computes md5 hex digests in process, streaming every file through one reused buffer"""
+	def __init__(self,bufferSize=HASH_BUFFER_SIZE):
+		self.buffer = bytearray(bufferSize)
+		self.view = memoryview(self.buffer)
+
+	def hash(self,filename):
+		import hashlib
+		md5 = hashlib.md5()
+		f = io.open(filename,"rb",buffering=0)
+		try:
+			while True:
+				n = f.readinto(self.buffer)
+				if not n: break
+				md5.update(self.view[:n])
+		finally:
+			f.close()
+		return md5.hexdigest()
+
+	def verify(self,filename):
+		"""Returns the md5 hex digest of filename as read from disk, bypassing the page cache"""
+		import hashlib
+		md5 = hashlib.md5()
+		f = io.open(filename,"rb",buffering=0)
+		try:
+			dropCache(f.fileno())
+			while True:
+				n = f.readinto(self.buffer)
+				if not n: break
+				md5.update(self.view[:n])
+			dropCache(f.fileno())
+		finally:
+			f.close()
+		return md5.hexdigest()
+
+	def copy(self,source,target,sniff=None):
+		"""Copies source to target and returns the md5 hex digest, reading source only once"""
+		import hashlib
+		md5 = hashlib.md5()
+		src = io.open(source,"rb",buffering=0)
+		try:
+			n = src.readinto(self.buffer)
+			if sniff != None and not sniff(source,self.view[:n]):
+				return None
+			dst = io.open(target,"wb",buffering=0)
+			try:
+				if reflink(src.fileno(),dst.fileno()):
+					while n:
+						md5.update(self.view[:n])
+						n = src.readinto(self.buffer)
+					return md5.hexdigest()
+				while n:
+					md5.update(self.view[:n])
+					written = 0
+					while written < n:
+						written += dst.write(self.view[written:n])
+					n = src.readinto(self.buffer)
+			finally:
+				dst.close()
+		finally:
+			src.close()
+		return md5.hexdigest()
+
+class CatalogEntry(object):
+	"""A single row of the backup info file"""
+	__slots__ = ("hash","filename","filesize","backupset","stored_to_external","media_title")
+
+	def __init__(self,hash,filename,filesize,backupset,stored_to_external,media_title):
+		self.hash = hash
+		self.filename = filename
+		self.filesize = filesize
+		self.backupset = intern(backupset)
+		self.stored_to_external = stored_to_external
+		self.media_title = intern(media_title)
+
+	def line(self):
+		"""The row as written to the backup info file"""
+		return "%s,%s,%d,%s,%s,%s" % (self.hash,self.filename,self.filesize,self.backupset,self.stored_to_external,self.media_title)
+
+class CatalogJournal:
+	"""Append-only journal of changes to a backup info file"""
+	# @journal=<id>, then transactions of @begin=<label>, +<row>, @medium=<title>,
+	# *<hash>,<backupset>,<filename>, %<key>=<value> and @commit. Byte 0 of the lock file
+	# guards appends and swaps, byte 1 the compactor
+	lockFiles = {}
+
+	def __init__(self,filename,sync=False):
+		self.filename = filename
+		self.journalFilename = filename+".journal"
+		self.sync = sync
+
+	def lock(self,operation,start=0):
+		"""Locks a byte of the lock file. Returns False if the lock was not taken"""
+		# One descriptor per process, closing another would drop all its locks on the file
+		lockFile = self.lockFiles.get(path.abspath(self.filename))
+		if lockFile == None:
+			try:
+				lockFile = open(self.filename+".lock","a+")
+			except IOError:
+				return False
+			self.lockFiles[path.abspath(self.filename)] = lockFile
+		try:
+			fcntl.lockf(lockFile.fileno(),operation,1,start)
+		except IOError:
+			return False
+		return True
+
+	def unlock(self,start=0):
+		lockFile = self.lockFiles.get(path.abspath(self.filename))
+		if lockFile != None:
+			fcntl.lockf(lockFile.fileno(),fcntl.LOCK_UN,1,start)
+
+	def openFiles(self,lock=True):
+		"""Opens the base file and the journal. The journal is None if there is none"""
+		locked = lock and self.lock(fcntl.LOCK_SH)
+		try:
+			base = open(self.filename,"r")
+			try:
+				journal = open(self.journalFilename,"r")
+			except IOError:
+				journal = None
+		finally:
+			if locked: self.unlock()
+		return base,journal
+
+	def read(self,f):
+		"""Reads the journal id and the committed transactions of the journal file f"""
+		journalId = None
+		transactions = []
+		offset = 0
+		start = 0
+		label = None
+		records = []
+		for line in f:
+			begin = offset
+			offset += len(line)
+			line = line.rstrip("\n")
+			if line.startswith("@begin="):
+				start = begin
+				label = line[7:]
+				records = []
+			elif line == "@commit":
+				if label != None:
+					transactions.append((start,offset,label,records))
+				label = None
+			elif line.startswith("@journal="):
+				journalId = line[9:]
+			elif label != None:
+				records.append(line)
+		return journalId,transactions
+
+	def size(self):
+		if path.isfile(self.journalFilename):
+			return path.getsize(self.journalFilename)
+		return 0
+
+	def append(self,label,records):
+		"""Appends records as one committed transaction"""
+		lines = ["@begin=%s\n" % label]
+		for record in records:
+			lines.append(record+"\n")
+		lines.append("@commit\n")
+		self.lock(fcntl.LOCK_EX)
+		try:
+			f = open(self.journalFilename,"a+")
+			f.seek(0,2)
+			if f.tell() == 0:
+				f.write("@journal=%s\n" % newJournalId())
+			else:
+				self.dropIncomplete(f)
+			f.writelines(lines)
+			if self.sync:
+				f.flush()
+				os.fsync(f.fileno())
+			f.close()
+		finally:
+			self.unlock()
+
+	def dropIncomplete(self,f):
+		"""Truncates an incomplete transaction left at the end of f by an interrupted append"""
+		f.seek(0,2)
+		size = f.tell()
+		f.seek(max(0,size-8))
+		if f.read() == "@commit\n": return
+		f.seek(0)
+		header = f.readline()
+		f.seek(0)
+		journalId,transactions = self.read(f)
+		end = transactions and transactions[-1][1] or len(header)
+		if end != size: f.truncate(end)
+
+	def lastChange(self):
+		"""Returns the start offset and label of the last change in the journal"""
+		start,label = 0,None
+		try:
+			f = open(self.journalFilename,"r")
+		except IOError:
+			return start,label
+		journalId,transactions = self.read(f)
+		f.close()
+		for i in range(len(transactions)):
+			begin,end,l,records = transactions[i]
+			if l != label:
+				start,label = i > 0 and begin or 0,l
+		return start,label
+
+	def undo(self):
+		"""Removes the last change from the journal and returns its label"""
+		self.lock(fcntl.LOCK_EX)
+		try:
+			start,label = self.lastChange()
+			if label != None:
+				f = open(self.journalFilename,"r+")
+				f.truncate(start)
+				f.close()
+			return label
+		finally:
+			self.unlock()
+
+	def replace(self,filename,offset):
+		"""Installs filename as the new base file and drops the journal up to offset"""
+		self.lock(fcntl.LOCK_EX)
+		try:
+			journal = open(self.journalFilename,"r")
+			journal.seek(offset)
+			tail = journal.read()
+			journal.close()
+			f = open(self.journalFilename+".tmp","w")
+			if tail != "":
+				f.write("@journal=%s\n" % newJournalId())
+				f.write(tail)
+			f.flush()
+			os.fsync(f.fileno())
+			f.close()
+			f = open(filename,"r")
+			os.fsync(f.fileno())
+			f.close()
+			os.rename(filename,self.filename)
+			os.rename(self.journalFilename+".tmp",self.journalFilename)
+		finally:
+			self.unlock()
+
+class MappedCatalog:
+	"""Read-only view of a backup info file through a memory map and a sidecar index"""
+	def __init__(self,f,filename,readOnly=False):
+		import mmap, struct
+		self.indexHeader = struct.Struct("<8sQQQQQ")
+		self.hashRecord = struct.Struct(">16sQ")
+		self.offsetRecord = struct.Struct("<Q")
+		self.filename = filename
+		self.readOnly = readOnly
+		st = os.fstat(f.fileno())
+		self.key = (st.st_ino,st.st_size,mtimeNs(st))
+		if st.st_size > 0:
+			self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+		else:
+			self.map = None
+		self.index = None
+		self.journalRows = []
+		self.journalHashes = None
+		self.journalBackupsets = None
+		self.marks = {}
+
+	def setJournal(self,rows,marks):
+		"""Overlays the rows and the stored marks of the journal"""
+		self.journalRows = rows
+		self.journalHashes = None
+		self.journalBackupsets = None
+		self.marks = marks
+
+	def indexJournal(self):
+		"""Indexes the journal rows by hash and by backupset"""
+		if self.journalHashes != None: return
+		self.journalHashes = {}
+		self.journalBackupsets = {}
+		for s in self.journalRows:
+			self.journalHashes.setdefault(s[0],[]).append(s)
+			self.journalBackupsets.setdefault(s[3],[]).append(s)
+
+	def close(self):
+		import mmap
+		if self.map != None: self.map.close()
+		if isinstance(self.index,mmap.mmap): self.index.close()
+
+	def header(self):
+		"""Returns the meta data lines at the top of the catalog"""
+		lines = []
+		offset = 0
+		while self.map != None and self.map[offset:offset+1] == "%":
+			end = self.map.find("\n",offset)
+			if end < 0: end = len(self.map)
+			lines.append(self.map[offset:end])
+			offset = end+1
+		return lines
+
+	def blocks(self):
+		"""Yields the lines of the catalog in lists, splitting large blocks of the map at once"""
+		if self.map == None: return
+		self.map.seek(0)
+		for lines in readLineBlocks(self.map):
+			yield lines
+
+	def rows(self):
+		"""Yields every row as a list of fields, followed by the rows of the journal"""
+		marks = self.marks
+		for lines in self.blocks():
+			for line in lines:
+				if line == "" or line[0] == "%":
+					continue
+				s = line.split(",")
+				if marks and len(s) > 5:
+					mediaTitle = marks.get((s[0],s[3],s[1]))
+					if mediaTitle != None:
+						s[4] = "True"
+						s[5] = mediaTitle
+				yield s
+		for s in self.journalRows:
+			yield s
+
+	def row(self,offset):
+		"""Decodes the row at offset"""
+		end = self.map.find("\n",offset)
+		if end < 0: end = len(self.map)
+		s = self.map[offset:end].split(",")
+		if self.marks:
+			mediaTitle = self.marks.get((s[0],s[3],s[1]))
+			if mediaTitle != None:
+				s[4] = "True"
+				s[5] = mediaTitle
+		return s
+
+	def count(self):
+		self.loadIndex()
+		return self.rowCount+len(self.journalRows)
+
+	def lookup(self,hash):
+		"""Returns the rows with the given hash"""
+		import binascii
+		self.loadIndex()
+		digest = binascii.unhexlify(hash)
+		index = self.index
+		size = self.hashRecord.size
+		lo,hi = 0,self.rowCount
+		while lo < hi:
+			mid = (lo+hi)//2
+			position = self.hashStart+mid*size
+			if index[position:position+16] < digest:
+				lo = mid+1
+			else:
+				hi = mid
+		rows = []
+		while lo < self.rowCount:
+			key,offset = self.hashRecord.unpack_from(index,self.hashStart+lo*size)
+			if key != digest: break
+			rows.append(self.row(offset))
+			lo += 1
+		self.indexJournal()
+		rows.extend(self.journalHashes.get(hash,[]))
+		return rows
+
+	def backupsets(self):
+		"""Returns the names of all backupsets"""
+		self.loadIndex()
+		self.indexJournal()
+		names = dict.fromkeys(self.backupsetIndex.keys())
+		names.update(dict.fromkeys(self.journalBackupsets.keys()))
+		return names.keys()
+
+	def backupsetRows(self,name):
+		"""Yields the rows of the backupset name"""
+		import struct
+		self.loadIndex()
+		if self.backupsetIndex.has_key(name):
+			start,count = self.backupsetIndex[name]
+			offsets = struct.unpack_from("<%dQ" % count,self.index,self.offsetStart+start*self.offsetRecord.size)
+			for offset in offsets:
+				yield self.row(offset)
+		self.indexJournal()
+		for s in self.journalBackupsets.get(name,[]):
+			yield s
+
+	def loadIndex(self):
+		import mmap, struct
+		if self.index != None: return
+		try:
+			f = open(self.filename+".idx","rb")
+			try:
+				index = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+			finally:
+				f.close()
+			if self.indexHeader.unpack_from(index,0)[:4] == (CATALOG_INDEX_MAGIC,)+self.key:
+				self.setIndex(index)
+				return
+			index.close()
+		except (EnvironmentError,ValueError,struct.error):
+			pass
+		self.setIndex(self.buildIndex())
+
+	def setIndex(self,index):
+		import struct
+		magic,inode,size,mtime,self.rowCount,backupsetCount = self.indexHeader.unpack_from(index,0)
+		self.hashStart = self.indexHeader.size
+		position = self.hashStart+self.rowCount*self.hashRecord.size
+		self.backupsetIndex = {}
+		for i in range(backupsetCount):
+			length, = struct.unpack_from("<H",index,position)
+			name = index[position+2:position+2+length]
+			start,count = struct.unpack_from("<QQ",index,position+2+length)
+			self.backupsetIndex[name] = (start,count)
+			position += 2+length+16
+		self.offsetStart = position
+		self.index = index
+
+	def buildIndex(self):
+		"""Writes the index of the catalog and returns it mapped"""
+		import binascii, mmap, struct
+		buckets = [bytearray() for i in range(256)]
+		backupsets = {}
+		packHash = self.hashRecord.pack
+		packOffset = self.offsetRecord.pack
+		rowCount = 0
+		offset = 0
+		for lines in self.blocks():
+			for line in lines:
+				if line != "" and line[0] != "%":
+					s = line.split(",",4)
+					digest = binascii.unhexlify(s[0])
+					buckets[ord(digest[0])] += packHash(digest,offset)
+					if not backupsets.has_key(s[3]):
+						backupsets[s[3]] = bytearray()
+					backupsets[s[3]] += packOffset(offset)
+					rowCount += 1
+				offset += len(line)+1
+		filename = self.filename+".idx"
+		tmpFilename = "%s.%d.tmp" % (filename,os.getpid())
+		out = None
+		if not self.readOnly:
+			try:
+				out = open(tmpFilename,"wb")
+			except IOError:
+				pass
+		if out == None:
+			from cStringIO import StringIO
+			out = StringIO()
+		size = self.hashRecord.size
+		out.write(self.indexHeader.pack(CATALOG_INDEX_MAGIC,self.key[0],self.key[1],self.key[2],rowCount,len(backupsets)))
+		for bucket in buckets:
+			records = [str(bucket[i:i+size]) for i in xrange(0,len(bucket),size)]
+			records.sort()
+			out.write("".join(records))
+		start = 0
+		names = backupsets.keys()
+		for name in names:
+			count = len(backupsets[name])/self.offsetRecord.size
+			out.write(struct.pack("<H",len(name))+name+struct.pack("<QQ",start,count))
+			start += count
+		for name in names:
+			out.write(str(backupsets[name]))
+		if not isinstance(out,file):
+			return out.getvalue()
+		out.close()
+		os.rename(tmpFilename,filename)
+		f = open(filename,"rb")
+		try:
+			return mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+
+class SqliteCatalog:
+	"""Catalog kept in an indexed SQLite database in the destination directory"""
+	def __init__(self,filename,sync=True):
+		import sqlite3
+		self.db = sqlite3.connect(filename,timeout=60)
+		self.db.text_factory = str
+		if not sync: self.db.execute("PRAGMA synchronous=OFF")
+		self.db.executescript(SQLITE_SCHEMA)
+
+	def getMetadata(self):
+		return dict(self.db.execute("SELECT key,value FROM metadata").fetchall())
+
+	def setMetadata(self,key,value):
+		self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?,?)",(key,value))
+
+	def deleteMetadata(self,key):
+		self.db.execute("DELETE FROM metadata WHERE key=?",(key,))
+
+	def count(self):
+		return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+	def insert(self,entries):
+		rows = [(e.hash,e.filename,e.filesize,e.backupset,int(e.stored_to_external),e.media_title) for e in entries]
+		self.db.executemany("INSERT INTO entries (hash,filename,filesize,backupset,stored_to_external,media_title) VALUES (?,?,?,?,?,?)",rows)
+
+	def select(self,clause="",args=()):
+		"""Yields the entries selected by an SQL clause such as "WHERE hash=?" """
+		cursor = self.db.execute("SELECT hash,filename,filesize,backupset,stored_to_external,media_title FROM entries "+clause,args)
+		for hash,filename,filesize,backupset,stored,mediaTitle in cursor:
+			yield CatalogEntry(hash,filename,filesize,backupset,stored == 1,mediaTitle)
+
+	def markStored(self,entry):
+		self.db.execute("UPDATE entries SET stored_to_external=1, media_title=? WHERE hash=? AND backupset=? AND filename=?",(entry.media_title,entry.hash,entry.backupset,entry.filename))
+
+	def unmarkStored(self,mediaTitle):
+		self.db.execute("UPDATE entries SET stored_to_external=0, media_title='Unknown' WHERE media_title=?",(mediaTitle,))
+
+	def statistics(self):
+		"""Returns (media_title,count,size,stored count,stored size) for every media title"""
+		return self.db.execute("SELECT media_title,COUNT(*),SUM(filesize),SUM(stored_to_external),SUM(filesize*stored_to_external) FROM entries GROUP BY media_title").fetchall()
+
+	def commit(self):
+		self.db.commit()
+
+	def rollback(self):
+		self.db.rollback()
+
+	def close(self):
+		self.db.close()
+
+class SqliteIndex:
+	"""Dict-like view of an indexed column of a SqliteCatalog"""
+	def __init__(self,catalog,column):
+		self.catalog = catalog
+		self.column = column
+
+	def has_key(self,value):
+		return self.catalog.db.execute("SELECT 1 FROM entries WHERE %s=? LIMIT 1" % self.column,(value,)).fetchone() != None
+
+	__contains__ = has_key
+
+	def get(self,value,default=None):
+		entries = list(self.catalog.select("WHERE %s=?" % self.column,(value,)))
+		if len(entries) == 0: return default
+		return entries
+
+	def __getitem__(self,value):
+		entries = self.get(value)
+		if entries == None: raise KeyError(value)
+		return entries
+
+class HashPool:
+	"""Hashes files on a pool of worker threads or processes fed through a bounded queue"""
+	def __init__(self,jobs,kind="thread",queueDepth=HASH_QUEUE_DEPTH):
+		import Queue, threading, multiprocessing
+		if kind == "process":
+			self.tasks = multiprocessing.Queue(jobs*queueDepth)
+			self.results = multiprocessing.Queue()
+			worker = multiprocessing.Process
+		else:
+			self.tasks = Queue.Queue(jobs*queueDepth)
+			self.results = Queue.Queue()
+			worker = threading.Thread
+		self.pending = 0
+		self.workers = []
+		for i in range(jobs):
+			w = worker(target=_hashWorker,args=(self.tasks,self.results))
+			w.daemon = True
+			w.start()
+			self.workers.append(w)
+
+	def submit(self,filename):
+		"""Queues filename for hashing, blocking while the queue is full"""
+		self.tasks.put(filename)
+		self.pending += 1
+
+	def completed(self,block=False):
+		"""Yields (filename,hash,error) for finished files"""
+		import Queue
+		while self.pending > 0:
+			try:
+				result = self.results.get(block)
+			except Queue.Empty:
+				return
+			self.pending -= 1
+			yield result
+
+	def close(self):
+		for w in self.workers:
+			self.tasks.put(None)
+		for w in self.workers:
+			w.join()
+
+class CopyPool:
+	"""Copies files on a pool of worker threads with a bound on the bytes in flight"""
+	def __init__(self,jobs,copy,maxInflight=COPY_MAX_INFLIGHT):
+		import Queue, threading
+		self.tasks = Queue.Queue()
+		self.results = Queue.Queue()
+		self.copy = copy
+		self.maxInflight = maxInflight
+		self.inflight = 0
+		self.sizes = {}
+		self.tasksById = {}
+		self.done = {}
+		self.submitted = 0
+		self.next = 0
+		self.workers = []
+		for i in range(jobs):
+			w = threading.Thread(target=self._worker)
+			w.daemon = True
+			w.start()
+			self.workers.append(w)
+
+	def _worker(self):
+		hasher = Hasher()
+		while True:
+			item = self.tasks.get()
+			if item == None: break
+			id,task = item
+			try:
+				self.results.put((id,self.copy(task,hasher)))
+			except Exception, e:
+				self.results.put((id,(None,str(e))))
+
+	def submit(self,task,size):
+		"""Queues task, waiting while the bytes in flight would exceed the bound"""
+		while self.inflight > 0 and self.inflight+size > self.maxInflight:
+			self._receive()
+		self.sizes[self.submitted] = size
+		self.tasksById[self.submitted] = task
+		self.inflight += size
+		self.tasks.put((self.submitted,task))
+		self.submitted += 1
+
+	def _receive(self,block=True):
+		"""Moves one finished copy to the done dict. Returns False if none was ready"""
+		import Queue
+		while True:
+			try:
+				id,result = self.results.get(block,0.5)
+				break
+			except Queue.Empty:
+				if not block: return False
+		self.inflight -= self.sizes.pop(id)
+		self.done[id] = result
+		return True
+
+	def completed(self,block=False):
+		"""Yields (task,result) in submission order for the copies that have finished"""
+		while self._receive(False): pass
+		while self.next < self.submitted:
+			if not self.done.has_key(self.next):
+				if not block: return
+				self._receive()
+				continue
+			yield self.tasksById.pop(self.next),self.done.pop(self.next)
+			self.next += 1
+
+	def close(self):
+		for w in self.workers:
+			self.tasks.put(None)
+		for w in self.workers:
+			w.join()
+
+class HashCache:
+	"""Persistent cache of source file hashes keyed by device, inode, size and mtime"""
+	def __init__(self,filename):
+		import sqlite3
+		self.db = sqlite3.connect(filename,timeout=60)
+		self.db.execute("CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, hash BLOB, seen INTEGER, PRIMARY KEY (dev,ino)) WITHOUT ROWID")
+		self.db.commit()
+		self.today = int(time.time()/86400)
+		self.hits = 0
+		self.stored = []
+		self.seen = []
+
+	def lookup(self,st):
+		"""Returns the cached hash for st, or None if the file is unknown or has changed"""
+		import binascii
+		row = self.db.execute("SELECT size,mtime,hash,seen FROM hashes WHERE dev=? AND ino=?",(st.st_dev,st.st_ino)).fetchone()
+		if row == None or row[0] != st.st_size or row[1] != mtimeNs(st):
+			return None
+		if row[3] != self.today:
+			self.seen.append((self.today,st.st_dev,st.st_ino))
+		self.hits += 1
+		return binascii.hexlify(row[2])
+
+	def store(self,st,hash):
+		import binascii
+		self.stored.append((st.st_dev,st.st_ino,st.st_size,mtimeNs(st),buffer(binascii.unhexlify(hash)),self.today))
+		if len(self.stored) >= HASH_CACHE_BATCH: self.flush()
+
+	def flush(self):
+		self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?)",self.stored)
+		self.db.executemany("UPDATE hashes SET seen=? WHERE dev=? AND ino=?",self.seen)
+		self.db.commit()
+		self.stored = []
+		self.seen = []
+
+	def close(self):
+		self.flush()
+		self.db.execute("DELETE FROM hashes WHERE seen<?",(self.today-HASH_CACHE_MAX_AGE,))
+		self.db.commit()
+		self.db.close()
+
+def _hashWorker(tasks,results):
+	hasher = Hasher()
+	while True:
+		filename = tasks.get()
+		if filename == None: break
+		try:
+			results.put((filename,hasher.hash(filename),None))
+		except IOError, e:
+			results.put((filename,None,e.strerror))
 
 class Backup:
 	def __init__(self,options):
@@ -45,8 +778,28 @@ class Backup:
 		self.tmpBackupInfoFile = None
 		self.thumbnailCommand = "exiv2"
 		self.metadata = {}
+		self.hasher = Hasher()
+		self.hashCache = None
+		self.mediaExtensions = {}
+		self.catalog = None
+		self.journalRecords = []
+		self.checkpointed = time.time()
+		self.pendingRows = 0
+		self.unsynced = []
+		self.resuming = False
+		self.failedCopies = 0
+		self.verifyPool = None
+		self.verifyStats = None
+		self.storedEntries = {}
 		self.o = OutputText()
 		try:
+			if self.options.export_catalog != None:
+				self.prelaunchCheckDestination()
+				self.exportCatalog(path.abspath(self.options.export_catalog))
+				self.abort(0)
+			if self.options.lookup:
+				self.lookup()
+				self.abort(0)
 			if self.options.undo:
 				self.prelaunchCheckDestination()
 				self.undo()
@@ -83,6 +836,7 @@ class Backup:
 			self.abort(1)
 		
 	def prelaunchCheckDestination(self):
+		import shutil
 		if self.options.clean_destination:
 			answer = raw_input(bold("About to completely remove %s. Do you really want to continue? [y/N] " % self.options.destination))
 			if answer not in ("Y","y"):
@@ -107,8 +861,8 @@ class Backup:
 
 	def prelaunchCheckThumbnails(self):
 		if self.options.thumbnails:
-			cmd = commands.getoutput("which %s" % self.thumbnailCommand)
-			if cmd == "": 
+			cmd = which(self.thumbnailCommand)
+			if cmd == None: 
 				self.options.thumbnails = False
 				if self.options.verbose: print blue("%s not found, skipping thumbnail creation" % self.thumbnailCommand)
 			else: 
@@ -125,35 +879,178 @@ class Backup:
 						self.abort(1)
 			
 	def createNewBackupSet(self):
+		"""Creates a new backup set, or resumes an interrupted one"""
 		self.backupSetName = time.strftime("%Y%m%d-%H%M",time.localtime())
+		resume = self.readResumeFile()
+		if resume.get("source") == path.abspath(self.options.source) and path.isdir(path.join(self.options.destination,resume.get("backupset",""))):
+			answer = raw_input(bold('An interrupted backup of this source to backup set "%s" was found, should it be resumed? [Y/n] ' % resume["backupset"]))
+			if not answer in ("n","N"):
+				self.backupSetName = resume["backupset"]
+				self.resuming = True
+
+	def getResumeFile(self):
+		return path.join(self.options.destination,self.options.backup_info_file+".resume")
+
+	def readResumeFile(self):
+		"""Returns the source and backup set of an interrupted backup, or an empty dict"""
+		resume = {}
+		try:
+			f = open(self.getResumeFile())
+		except IOError:
+			return resume
+		for line in f:
+			key,sep,value = line.rstrip("\n").partition("=")
+			if sep: resume[key] = value
+		f.close()
+		return resume
+
+	def writeResumeFile(self):
+		"""Records the running backup, so it can be resumed if it is interrupted"""
+		f = open(self.getResumeFile()+".tmp","w")
+		f.write("source=%s\nbackupset=%s\n" % (path.abspath(self.options.source),self.backupSetName))
+		f.close()
+		os.rename(self.getResumeFile()+".tmp",self.getResumeFile())
+
+	def removeResumeFile(self):
+		if path.isfile(self.getResumeFile()): os.remove(self.getResumeFile())
 		
 	def abort(self,exitCode):
 		if self.tmpBackupInfoFile != None:
 			self.tmpBackupInfoFile.close()
+		if self.hashCache != None:
+			self.hashCache.close()
+		self.syncData()
+		if self.catalog != None:
+			# Keep the rows of files a backup has copied, but not those marked by a burn
+			if self.pendingRows > 0: self.catalog.commit()
+			self.catalog.close()
+		self.flushJournal()
 		if exitCode != 0: print bad("\nAborting")
 		sys.exit(exitCode)
 		
 	def startBackup(self):
 		if self.options.verbose: print blue("Starting backup process")
 		self.previousBackupSet = self.getPreviousBackupSet()
+		self.catalogSizes = self.getCatalogSizes(self.previousBackupSet)
 		self.currentBackupSet = self.getCurrentBackupSet()
 		self.filesToBackup = self.getFilesToBackup()
 		if len(self.filesToBackup) != 0:
 			self.backupFiles()
 		else:
 			print "Nothing to backup"
+		if self.failedCopies > 0:
+			print >> sys.stderr, bad("%d files could not be copied, run the backup again to resume backup set %s" % (self.failedCopies,self.backupSetName))
+		elif not self.options.dry_run:
+			self.removeResumeFile()
+		if self.hashCache != None:
+			self.hashCache.close()
+			self.hashCache = None
+
+	def getCatalogSizes(self,backupSet):
+		"""Maps every file size in backupSet to the entries of that size"""
+		if self.catalog != None:
+			return SqliteIndex(self.catalog,"filesize")
+		sizes = {}
+		for hash,entries in backupSet.items():
+			for entry in entries:
+				size = entry.filesize
+				if not sizes.has_key(size):
+					sizes[size] = []
+				sizes[size].append(entry)
+		return sizes
 		
 	def getPreviousBackupSet(self):
+		filename = path.join(self.options.destination,self.options.backup_info_file)
+		if self.useSqliteCatalog():
+			return self.openSqliteCatalog(filename)
+		return self.readBackupInfoFile(self.getBackupInfoFile())
+
+	def getBackupInfoFile(self):
+		"""Path of the backup info file, which is created if there is none"""
 		filename = path.join(self.options.destination,self.options.backup_info_file)
 		if path.exists(filename):
 			if not path.isfile(filename):
-				print >> sys.stderr, red(bold("%s is not a valid file"))
+				print >> sys.stderr, red(bold("%s is not a valid file" % filename))
 				self.abort(1)
-			return self.readBackupInfoFile(filename)
 		else:
 			if self.options.verbose: print blue("No previous backup info file found, creating new")
 			self.createNewBackupInfoFile(filename)
-			return self.readBackupInfoFile(filename)
+		return filename
+
+	def getSqliteCatalogFile(self):
+		return path.join(self.options.destination,path.splitext(self.options.backup_info_file)[0]+".db")
+
+	def useSqliteCatalog(self):
+		"""The SQLite catalog is used if --catalog=sqlite is given, or if it exists"""
+		exists = path.isfile(self.getSqliteCatalogFile())
+		if exists and self.options.catalog == "text" and self.options.export_catalog == None:
+			print >> sys.stderr, bad("The catalog is kept in %s. Export it with --export-catalog and remove the database before using --catalog=text" % self.getSqliteCatalogFile())
+			self.abort(1)
+		return exists or self.options.catalog == "sqlite"
+
+	def openSqliteCatalog(self,filename):
+		"""Opens the SQLite catalog, importing the backup info file if it is new"""
+		if self.catalog == None:
+			dbFile = self.getSqliteCatalogFile()
+			if self.options.verbose: print blue("Opening catalog %s" % dbFile)
+			self.catalog = SqliteCatalog(dbFile,self.options.durability != "none")
+			if not self.catalog.getMetadata().has_key("version"):
+				if path.isfile(filename):
+					self.importCatalog(filename)
+				else:
+					self.catalog.setMetadata("version",VERSION)
+					self.catalog.commit()
+		self.metadata = self.catalog.getMetadata()
+		self.backupInfoFields = FIELDS[self.metadata["version"]]
+		self.backupSetSize = self.catalog.count()
+		self.pathIndex = SqliteIndex(self.catalog,"filename")
+		return SqliteIndex(self.catalog,"hash")
+
+	def importCatalog(self,filename):
+		"""Imports the backup info file and its journal into the SQLite catalog"""
+		print "Importing %s into %s" % (filename,self.getSqliteCatalogFile())
+		entries = []
+		for hash,values in self.readBackupInfoFile(filename).items():
+			entries.extend(values)
+			if len(entries) >= SQLITE_BATCH:
+				self.catalog.insert(entries)
+				entries = []
+		self.catalog.insert(entries)
+		if self.metadata.has_key("journal"): del self.metadata["journal"]
+		for key,value in self.metadata.items():
+			self.catalog.setMetadata(key,value)
+		self.catalog.commit()
+
+	def exportCatalog(self,filename):
+		"""Writes the catalog in the backup info file format to filename"""
+		self.getPreviousBackupSet()
+		if self.catalog == None:
+			print >> sys.stderr, bad("No SQLite catalog found in %s" % self.options.destination)
+			self.abort(1)
+		print "Exporting catalog to %s" % filename
+		self.storeBackupInfo(None,filename)
+
+	def catalogEntries(self,backupSet=None,stored=None):
+		"""Yields the entries of backupSet, or streams the catalog if it is None"""
+		if backupSet == None and self.useSqliteCatalog():
+			self.getPreviousBackupSet()
+		if self.catalog != None:
+			if stored == None:
+				entries = self.catalog.select()
+			else:
+				entries = self.catalog.select("WHERE stored_to_external=?",(int(stored),))
+			for entry in entries:
+				yield entry
+			return
+		if backupSet == None:
+			for s in self.catalogRows(self.getBackupInfoFile()):
+				if stored == None or (s[4] == "True") == stored:
+					yield CatalogEntry(s[0],s[1],int(s[2]),s[3],s[4] == "True",s[5])
+			return
+		for hash,entries in backupSet.items():
+			for entry in entries:
+				if stored == None or entry.stored_to_external == stored:
+					yield entry
 
 	def createNewBackupInfoFile(self,filename):
 		"""Creates a new backup info file"""
@@ -162,31 +1059,152 @@ class Backup:
 		print >> backupInfoFile, "%%version=%s" % (VERSION)
 		backupInfoFile.close()
 			
-	def readBackupInfoFile(self,filename):
+	def readBackupInfoFile(self,filename,journalEnd=None):
 		"""Reads the existing backup info file"""
+		import gc
 		self.backupSetSize = 0
-		if self.options.verbose: print blue("Reading existing backup info file %s" % filename)
 		backupSet = {}
-		backupInfoFile = open(filename,"r")
-		while True:
-			line = backupInfoFile.readline()
-			if line == "": break
-			if line.strip() == "":
-				continue
-			if line.startswith("%"):
-				self.handleMetaData(line[1:].strip())
-				continue
-			hash,value = self.parseLine(line)
-			if not backupSet.has_key(hash):
-				backupSet[hash] = []
-			backupSet[hash].append(value)
-			self.backupSetSize += 1
+		pathIndex = {}
+		# Millions of new objects would trigger the cyclic garbage collector over and over,
+		# although none of them can form a cycle
+		gc.disable()
+		try:
+			for s in self.catalogRows(filename,journalEnd):
+				hash = s[0]
+				entry = CatalogEntry(hash,s[1],int(s[2]),s[3],s[4] == "True",s[5])
+				if hash in backupSet:
+					backupSet[hash].append(entry)
+				else:
+					backupSet[hash] = [entry]
+				if entry.filename in pathIndex:
+					pathIndex[entry.filename].append(entry)
+				else:
+					pathIndex[entry.filename] = [entry]
+				self.backupSetSize += 1
+		finally:
+			gc.enable()
+		self.pathIndex = pathIndex
 		return backupSet
-					
 
+	def catalogRows(self,filename,journalEnd=None,metadata=True):
+		"""Yields every row of the backup info file and its journal as a list of fields"""
+		mapped = self.openMappedCatalog(filename,journalEnd,metadata)
+		fieldCount = len(self.backupInfoFields)
+		try:
+			for s in mapped.rows():
+				if len(s) != fieldCount:
+					print >> sys.stderr, red(bold("Syntax error in backup info file: %s" % ",".join(s)))
+					self.abort(1)
+				yield s
+		finally:
+			mapped.close()
+
+	def openMappedCatalog(self,filename,journalEnd=None,metadata=True,readOnly=False):
+		"""Maps the backup info file read-only and overlays its journal"""
+		if self.options.verbose: print blue("Reading existing backup info file %s" % filename)
+		journal = CatalogJournal(filename)
+		backupInfoFile,journalFile = journal.openFiles(not readOnly)
+		mapped = MappedCatalog(backupInfoFile,filename,readOnly)
+		backupInfoFile.close()
+		if metadata:
+			for line in mapped.header():
+				self.handleMetaData(line[1:].strip())
+		rows,marks = self.readJournal(journal,journalFile,journalEnd,metadata)
+		mapped.setJournal(rows,marks)
+		return mapped
+
+	def readJournal(self,journal,journalFile,journalEnd=None,metadata=True):
+		"""Replays the committed transactions of the journal file"""
+		rows = []
+		added = {}
+		marks = {}
+		self.journalId = None
+		if journalFile == None:
+			return rows,marks
+		self.journalId,transactions = journal.read(journalFile)
+		journalFile.close()
+		compacted = 0
+		if self.metadata.has_key("journal"):
+			journalId,offset = self.metadata["journal"].split(":")
+			if journalId == self.journalId: compacted = int(offset)
+		for start,end,label,records in transactions:
+			if end <= compacted: continue
+			if journalEnd != None and end > journalEnd: break
+			mediaTitle = "Unknown"
+			for record in records:
+				if record.startswith("+"):
+					s = self.splitLine(record[1:])
+					rows.append(s)
+					added[(s[0],s[3],s[1])] = s
+				elif record.startswith("*"):
+					key = tuple(record[1:].split(",",2))
+					marks[key] = mediaTitle
+					if added.has_key(key):
+						added[key][4] = "True"
+						added[key][5] = mediaTitle
+				elif record.startswith("%"):
+					if metadata: self.handleMetaData(record[1:])
+				elif record.startswith("@medium="):
+					mediaTitle = intern(record[8:])
+		return rows,marks
+
+	def getJournal(self):
+		return CatalogJournal(path.join(self.options.destination,self.options.backup_info_file),self.options.durability != "none")
+
+	def flushJournal(self):
+		"""Appends the pending rows of the running backup to the journal"""
+		if len(self.journalRecords) > 0:
+			self.getJournal().append(self.journalLabel,self.journalRecords)
+			self.journalRecords = []
+		self.checkpointed = time.time()
+		self.pendingRows = 0
+
+	def checkpoint(self,force=False):
+		"""Commits the rows of the running backup when a batch is due"""
+		if not force and self.options.durability != "file":
+			if self.pendingRows < JOURNAL_BATCH and time.time()-self.checkpointed < JOURNAL_CHECKPOINT_INTERVAL: return
+		self.syncData()
+		if self.catalog != None:
+			self.catalog.commit()
+			self.checkpointed = time.time()
+			self.pendingRows = 0
+		else:
+			self.flushJournal()
+
+	def syncData(self):
+		"""Writes back the files copied since the last commit"""
+		if len(self.unsynced) == 0: return
+		if not syncFileSystem(self.options.destination):
+			for target in self.unsynced: fsyncPath(target)
+			for directory in set([path.dirname(target) for target in self.unsynced]): fsyncPath(directory)
+		self.unsynced = []
+
+	def compactCatalog(self):
+		"""Folds a large journal into the backup info file in a forked child"""
+		journal = self.getJournal()
+		if self.options.dry_run or journal.size() < JOURNAL_COMPACT_SIZE: return
+		sys.stdout.flush()
+		if os.fork() != 0: return
+		exitCode = 0
+		try:
+			try:
+				if journal.lock(fcntl.LOCK_EX|fcntl.LOCK_NB,1):
+					offset,label = journal.lastChange()
+					if offset == 0: return
+					self.options.verbose = False
+					self.metadata = {}
+					backupSet = self.readBackupInfoFile(journal.filename,offset)
+					self.metadata["journal"] = "%s:%d" % (self.journalId,offset)
+					self.storeBackupInfo(backupSet,journal.filename+".compact")
+					journal.replace(journal.filename+".compact",offset)
+			except Exception, e:
+				print >> sys.stderr, bad("Catalog compaction failed: %s" % e)
+				exitCode = 1
+		finally:
+			os._exit(exitCode)
+			
 	def handleMetaData(self,metadata):
 		"""Handles a line of meta data from backup info file"""
-		if self.options.verbose: print blue("Handling %s" % (metadata))
 		key,data = metadata.split("=")
 		self.metadata[key] = data
 		if key == "version": self.backupInfoFields = FIELDS[data]
@@ -195,142 +1213,400 @@ class Backup:
 		"""Scans source directory and generates a backup set"""
 		print "Scanning source directory..."
 		backupSet = {}
-		self.collected = []
-		self.collecting = True
-		path.walk(self.options.source,self._sourceScanner,backupSet)
-		self.collecting = False
 		self.scanCount = 0
-		self.o.setMax(len(self.collected))
-		self.o.begin("Scanning %d source files..." % len(self.collected))
-		path.walk(self.options.source,self._sourceScanner,backupSet)
+		self.scanTotal = 0
+		jobs = self.options.jobs
+		if jobs <= 0: jobs = defaultJobs(self.options.source)
+		if jobs > 1:
+			if self.options.verbose: print blue("Hashing with %d %s workers" % (jobs,self.options.job_type))
+			self.hashPool = HashPool(jobs,self.options.job_type)
+		else:
+			self.hashPool = None
+		self.hashCache = self.openHashCache()
+		self.pendingStats = {}
+		self.unhashedFiles = []
+		self.catalogSamples = {}
+		if self.options.images:
+			import xdg.Mime
+			self.mime = xdg.Mime
+			# Load the database here, the copy workers sniff files concurrently
+			self.mime.get_type_by_name("file")
+		self.o.setMax(1)
+		self.o.begin("Scanning source files...")
+		for dirname,files in walkSource(self.options.source,self.options.follow_symlinks):
+			self._sourceScanner(backupSet,dirname,files)
+		if self.hashPool != None:
+			for filename,hash,error in self.hashPool.completed(block=True):
+				self.addHash(backupSet,filename,hash,error,self.pendingStats.pop(filename))
+			self.hashPool.close()
+			self.hashPool = None
 		self.o.end()
+		if self.options.verbose:
+			if self.hashCache != None: print blue("%d of %d hashes found in cache" % (self.hashCache.hits,self.scanCount))
+			print blue("%d files are new by size or sample and will be hashed while copying" % len(self.unhashedFiles))
 		return backupSet
+
+	def openHashCache(self):
+		"""Opens the persistent source hash cache, or returns None if it is disabled or unavailable"""
+		if not self.options.hash_cache: return None
+		import sqlite3
+		import xdg.BaseDirectory
+		cacheDir = path.join(xdg.BaseDirectory.xdg_cache_home,"imagebackup")
+		try:
+			if not path.isdir(cacheDir): os.makedirs(cacheDir)
+			return HashCache(path.join(cacheDir,"hashes.db"))
+		except (OSError,sqlite3.Error), e:
+			if self.options.verbose: print blue("Hash cache disabled: %s" % e)
+			return None
 		
-	def _sourceScanner(self,backupSet,dirname,names):
-		#if self.options.verbose: print "\tScanning %s" % dirname
-		#if not self.collecting:
-		#	self.o.title = "Scanning %s" % dirname
-		for name in names:
-			filename = path.join(dirname,name)
-			if path.isdir(filename) and path.islink(filename) and self.options.follow_symlinks: path.walk(dirname,self._sourceScanner,backupSet)
-			if path.isfile(filename):
-				if self.options.images:
-					t = mime_type(filename)
-					if not (t.media == "image" or t.media == "video"):
-						continue
-					#if not IMAGES.search(filename):
-					#	continue
-				if self.collecting:
-					self.collected.append(filename)
-				else:
-					self.scanCount += 1
-					self.o.setProgress(self.scanCount)
-					self.o.update()
-					hash = self.getHash(filename)
-					if not backupSet.has_key(hash):
-						backupSet[hash] = []
-					backupSet[hash].append([filename])
-				
+	def _sourceScanner(self,backupSet,dirname,files):
+		"""Hashes the files found in dirname"""
+		if self.options.images:
+			files = [(filename,st,self.isImageByName(filename)) for filename,st in files]
+			files = [(filename,st,media == None) for filename,st,media in files if media != False]
+		else:
+			files = [(filename,st,False) for filename,st in files]
+		if len(files) == 0: return
+		self.scanTotal += len(files)
+		self.o.title = "Scanning %d source files..." % self.scanTotal
+		self.o.setMax(self.scanTotal)
+		for filename,st,sniff in files:
+			hash = None
+			if self.hashCache != None:
+				hash = self.hashCache.lookup(st)
+			if hash == None and not self.mayBeBackedUp(filename,st):
+				self.scanCount += 1
+				self.o.setProgress(self.scanCount)
+				self.o.update()
+				self.unhashedFiles.append((filename,st,sniff))
+				continue
+			if sniff and not self.isImage(filename):
+				self.scanCount += 1
+				continue
+			if hash != None:
+				self.addHash(backupSet,filename,hash)
+				continue
+			if self.hashPool != None:
+				self.pendingStats[filename] = st
+				self.hashPool.submit(filename)
+				for filename,hash,error in self.hashPool.completed():
+					self.addHash(backupSet,filename,hash,error,self.pendingStats.pop(filename))
+			else:
+				try:
+					self.addHash(backupSet,filename,self.getHash(filename),None,st)
+				except IOError, e:
+					self.addHash(backupSet,filename,None,e.strerror)
+
+	def mayBeBackedUp(self,filename,st):
+		"""Returns False if no catalog entry can have the same content as filename"""
+		if not self.catalogSizes.has_key(st.st_size): return False
+		if st.st_size < SAMPLE_MIN_SIZE: return True
+		try:
+			sample = sampleDigest(filename,st.st_size)
+		except IOError:
+			return True
+		samples = self.getCatalogSamples(st.st_size)
+		return None in samples or sample in samples
+
+	def getCatalogSamples(self,size):
+		"""Sample digests of the catalog entries of size"""
+		if not self.catalogSamples.has_key(size):
+			samples = set()
+			for entry in self.catalogSizes.get(size,[]):
+				try:
+					samples.add(sampleDigest(path.join(self.options.destination,entry.backupset,entry.filename),size))
+				except (IOError,OSError):
+					samples.add(None)
+			self.catalogSamples[size] = samples
+		return self.catalogSamples[size]
+
+	def addHash(self,backupSet,filename,hash,error=None,st=None):
+		"""Adds the hash of a scanned file to backupSet"""
+		self.scanCount += 1
+		self.o.setProgress(self.scanCount)
+		self.o.update()
+		if error != None:
+			print >> sys.stderr, bad("\nCould not read %s: %s" % (filename,error))
+			return
+		if st != None and self.hashCache != None:
+			self.hashCache.store(st,hash)
+		if not backupSet.has_key(hash):
+			backupSet[hash] = []
+		backupSet[hash].append([filename])
+
+	def isImage(self,filename):
+		"""Returns True if filename is an image or a video"""
+		media = self.isImageByName(filename)
+		if media != None: return media
+		t = self.mime.get_type(filename)
+		return t.media in MEDIA_TYPES
+
+	def isImageByName(self,filename):
+		"""Classifies filename by its extension. Returns None if it must be sniffed"""
+		if self.options.classify == "extension":
+			name = path.basename(filename)
+			p = name.rfind(".")
+			if p > 0:
+				ext = name[p+1:].lower()
+				if not self.mediaExtensions.has_key(ext):
+					t = self.mime.get_type_by_name("file." + ext)
+					if t == None or str(t) in AMBIGUOUS_TYPES:
+						self.mediaExtensions[ext] = None
+					else:
+						self.mediaExtensions[ext] = t.media in MEDIA_TYPES
+				return self.mediaExtensions[ext]
+		return None
+
+	def isImageData(self,filename,data):
+		"""Classifies filename by the data at its head"""
+		byName = self.mime.get_type_by_name(filename)
+		data = data[:self.mime.magic.maxlen].tobytes()
+		t = self.mime.get_type_by_data(data,min_pri=100) or byName or self.mime.get_type_by_data(data,max_pri=100)
+		return t != None and t.media in MEDIA_TYPES
 				
 	def getHash(self,filename):
-		cmd = "md5sum '%s'" % (filename)
-		child = os.popen(cmd)
-		hash = child.read()
-		return hash.split()[0]
+		return self.hasher.hash(filename)
 		
 	def getFilesToBackup(self):
+		"""Diffs the current backup set against the catalog"""
 		filesToBackup = []
+		self.diff = {"new":[],"modified":[],"renamed":[],"unchanged":[]}
 		for hash,files in self.currentBackupSet.items():
-			if not self.previousBackupSet.has_key(hash):
-				filesToBackup.append((hash,files))
+			if self.previousBackupSet.has_key(hash):
+				previousNames = set([previousEntry.filename for previousEntry in self.previousBackupSet[hash]])
 			else:
-				previousFiles = self.previousBackupSet[hash]
-				found = False
-				equals = []
-				for previousEntry in previousFiles:
-					for file in files:
-						base = file[0][len(path.commonprefix([file[0],self.options.source])):].lstrip("/")
-						if base in previousEntry[0]:
-							found = True
-						else:
-							equals.append(previousEntry[0])
-				if not found:
-					if self.options.verbose:
-						pass
-					newFiles = []
-					for f in files:
-						newFiles.append(f[0][len(path.commonprefix([f[0],self.options.source])):].lstrip("/"))
-					print warn("Duplicate:"), "image already backed up under different name: %s == %s" % (newFiles,equals)
-					if not self.options.only_hash: filesToBackup.append((hash,[[file[0]]]))
+				previousNames = set()
+			newFiles = []
+			for file in files:
+				name = self.relativeSourcePath(file[0])
+				if name in previousNames:
+					category = "unchanged"
+				elif len(previousNames) != 0:
+					category = "renamed"
+				elif self.pathIndex.has_key(name):
+					category = "modified"
+				else:
+					category = "new"
+				self.diff[category].append(name)
+				if category == "unchanged": continue
+				if category == "renamed":
+					print warn("Duplicate:"), "image already backed up under different name: %s == %s" % (name,sorted(previousNames))
+					if self.options.only_hash: continue
+				elif category == "modified":
+					print warn("Modified:"), "file has changed since it was backed up: %s" % name
+				newFiles.append(file)
+			if len(newFiles) != 0:
+				filesToBackup.append((hash,newFiles))
+		for filename,st,sniff in self.unhashedFiles:
+			name = self.relativeSourcePath(filename)
+			if self.pathIndex.has_key(name):
+				print warn("Modified:"), "file has changed since it was backed up: %s" % name
+				self.diff["modified"].append(name)
+			else:
+				self.diff["new"].append(name)
+			filesToBackup.append((None,[[filename,st,sniff]]))
+		print "%d new, %d modified, %d renamed and %d unchanged files" % (len(self.diff["new"]),len(self.diff["modified"]),len(self.diff["renamed"]),len(self.diff["unchanged"]))
 		return filesToBackup
-	
+
+	def relativeSourcePath(self,filename):
+		"""Path of filename relative to the source directory"""
+		return filename[len(self.options.source):].lstrip("/")
+
 	def backupFiles(self):
 		backupDir = path.join(self.options.destination,self.backupSetName)
-		thumbDir = self.options.thumbnail_directory
-		if path.exists(backupDir):
+		if self.resuming:
+			print "Resuming backup set %s" % self.backupSetName
+		elif path.exists(backupDir):
 			answer =  raw_input(bold("There seems to be a backupset from within the last minute, should I proceed? [y/N] "))
 			if not answer in ("y", "Y"):
 				self.abort(0)
 		else:
 			if not self.options.dry_run: os.makedirs(backupDir)
+		if not self.options.dry_run: self.writeResumeFile()
+		files = []
+		for hash,group in self.filesToBackup:
+			for file in group:
+				filename = self.relativeSourcePath(file[0])
+				st = len(file) > 1 and file[1] or None
+				sniff = len(file) > 2 and file[2]
+				files.append((file[0],path.join(backupDir,filename),hash,filename,st,sniff))
+		if not self.options.dry_run:
+			self.knownDirectories = set([path.normpath(backupDir)])
+			if self.options.thumbnails: self.knownDirectories.add(path.normpath(self.options.thumbnail_directory))
+			directories = []
+			for source,target,hash,filename,st,sniff in files:
+				# Files still to be sniffed get their directories once they turn out to be images
+				if not sniff: directories.extend(self.targetDirectories(target,filename))
+			makeDirectories(directories,self.knownDirectories)
 		progress = 0
-		self.o.setMax(len(self.filesToBackup))
-		if not self.options.verbose: self.o.begin("Copying %d files..." % (len(self.filesToBackup)))
-		backupInfoFile = open(path.join(self.options.destination,self.options.backup_info_file),"a+")
-		for hash,files in self.filesToBackup:
-			progress += 1
-			if not self.options.verbose: 
-				self.o.setProgress(progress)
-				self.o.update()
-			for file in files:
-				s = path.commonprefix([self.options.source,file[0]])
-				filename = file[0][len(s):].lstrip("/")
-				target = path.join(backupDir,filename)
-				if self.options.verbose: print blue("\tCopy: %s -> %s" % (file[0],target))
-				if not path.isdir(path.dirname(target)):
-					if not self.options.dry_run: os.makedirs(path.dirname(target))
-				if not self.options.dry_run:
-					if path.isfile(target):
-						print >> sys.stderr, bad("File exists whith same name but files differ: %s" % (target))
-						self.abort(1)
-					shutil.copyfile(file[0],target)
-					if self.options.thumbnails:
-						thumbFile = path.join(thumbDir,filename)
-						if not path.isdir(path.dirname(thumbFile)): os.makedirs(path.dirname(thumbFile))
-						cmd = '%s -l "%s" -et "%s"' % (self.thumbnailCommand,path.dirname(thumbFile),target)
-						o = commands.getoutput(cmd)
-					if self.options.verify:
-						# TODO Create verification of copied files
-						pass
-					if path.isfile(target):
-						print >> backupInfoFile, self.createLine(hash,target)
-					else:
-						print >> sys.stderr, bad("File could not be copied: %s" % target)
-		backupInfoFile.close()
+		self.o.setMax(len(files))
+		if not self.options.verbose: self.o.begin("Copying %d files..." % (len(files)))
+		self.journalLabel = "backup %s" % self.backupSetName
+		if self.options.dry_run:
+			for source,target,hash,filename,st,sniff in files:
+				if sniff and not self.isImage(source): continue
+				if self.options.verbose: print blue("\tCopy: %s -> %s" % (source,target))
+		else:
+			jobs = self.options.copy_jobs
+			if jobs <= 0: jobs = defaultCopyJobs(self.options.source,self.options.destination)
+			if self.options.verbose: print blue("Copying with %d workers" % jobs)
+			pool = CopyPool(jobs,self._copyFile)
+			if self.options.verify:
+				self.verifyPool = CopyPool(jobs,self._verifyFile)
+				self.verifyStats = {"files":0,"bytes":0,"mismatches":0}
+				verifyStart = time.time()
+			for task in files:
+				source,target,hash,filename,st,sniff = task
+				if self.options.verbose: print blue("\tCopy: %s -> %s" % (source,target))
+				pool.submit(task,st != None and st.st_size or path.getsize(source))
+				for task,result in pool.completed():
+					progress += 1
+					self.copied(task,result,progress)
+				if self.verifyPool != None:
+					for task,result in self.verifyPool.completed():
+						self.verified(task,result)
+			for task,result in pool.completed(block=True):
+				progress += 1
+				self.copied(task,result,progress)
+			pool.close()
+			if self.verifyPool != None:
+				for task,result in self.verifyPool.completed(block=True):
+					self.verified(task,result)
+				self.verifyPool.close()
+				self.verifyPool = None
+				self.verifyStats["seconds"] = time.time()-verifyStart
+		self.checkpoint(True)
 		if not self.options.verbose: self.o.end()
-		
-	def parseLine(self,line):
-		"""Parse a single line from backup info file"""
+		if self.verifyStats != None: self.reportVerification()
+		if self.catalog == None: self.compactCatalog()
+
+	def _copyFile(self,task,hasher):
+		"""Copies a file on a copy worker. Returns (hash,error)"""
+		import commands
+		source,target,hash,filename,st,sniff = task
+		if path.isfile(target):
+			size = st != None and st.st_size or os.stat(source).st_size
+			if os.stat(target).st_size == size:
+				if hash == None: hash = hasher.hash(source)
+				if hasher.hash(target) == hash: return hash,None
+			if not self.resuming: return hash,"exists"
+		part = target+".part"
+		try:
+			if hash == None:
+				if sniff:
+					def isImage(name,data):
+						if not self.isImageData(name,data): return False
+						makeDirectories(self.targetDirectories(target,filename),self.knownDirectories)
+						return True
+					hash = hasher.copy(source,part,isImage)
+					if hash == None: return None,"skipped"
+				else:
+					hash = hasher.copy(source,part)
+			else:
+				copyFile(source,part,hasher.buffer)
+			if self.options.durability == "file": fsyncPath(part)
+			os.rename(part,target)
+		except Exception:
+			if path.isfile(part): os.unlink(part)
+			raise
+		if self.options.durability == "file": fsyncPath(path.dirname(target))
+		if self.options.thumbnails:
+			thumbFile = path.join(self.options.thumbnail_directory,filename)
+			cmd = '%s -l "%s" -et "%s"' % (self.thumbnailCommand,path.dirname(thumbFile),target)
+			o = commands.getoutput(cmd)
+		return hash,None
+
+	def targetDirectories(self,target,filename):
+		"""Directories a copy to target and its thumbnail are written to"""
+		directories = [path.dirname(target)]
+		if self.options.thumbnails:
+			directories.append(path.dirname(path.join(self.options.thumbnail_directory,filename)))
+		return directories
+
+	def _verifyFile(self,task,hasher):
+		"""Re-reads a copied file from disk on a verify worker. Returns (hash,error)"""
+		target,hash,size = task
+		return hasher.verify(target),None
+
+	def copied(self,task,result,progress):
+		"""Records a finished copy in the catalog. Called in submission order"""
+		source,target,oldHash,filename,st,sniff = task
+		hash,error = result
+		if not self.options.verbose:
+			self.o.setProgress(progress)
+			self.o.update()
+		if error == "exists":
+			print >> sys.stderr, bad("File exists whith same name but files differ: %s" % (target))
+			self.abort(1)
+		if error == "skipped":
+			if self.options.verbose: print blue("\tSkipped, not an image: %s" % source)
+			return
+		if error != None or not path.isfile(target):
+			print >> sys.stderr, bad("File could not be copied: %s (%s)" % (target,error or "target missing"))
+			self.failedCopies += 1
+			return
+		if oldHash == None and self.hashCache != None: self.hashCache.store(st,hash)
+		if self.verifyPool != None:
+			size = os.stat(target).st_size
+			self.verifyPool.submit((target,hash,size),size)
+		else:
+			self.record(hash,target)
+
+	def verified(self,task,result):
+		"""Records a copy once its hash is verified"""
+		target,hash,size = task
+		actual,error = result
+		self.verifyStats["files"] += 1
+		self.verifyStats["bytes"] += size
+		if error != None or actual != hash:
+			self.verifyStats["mismatches"] += 1
+			self.failedCopies += 1
+			print >> sys.stderr, bad("Verification failed, removing %s: %s" % (target,error or "expected %s, read %s" % (hash,actual)))
+			try:
+				os.remove(target)
+			except OSError:
+				pass
+			return
+		self.record(hash,target)
+
+	def record(self,hash,target):
+		"""Adds a copied file to the catalog"""
+		if self.catalog != None:
+			self.catalog.insert([self.createEntry(hash,target)])
+		else:
+			self.journalRecords.append("+"+self.createLine(hash,target))
+		if self.options.durability == "batch": self.unsynced.append(target)
+		self.pendingRows += 1
+		self.checkpoint()
+
+	def reportVerification(self):
+		"""Prints the outcome and throughput of --verify"""
+		stats = self.verifyStats
+		seconds = stats["seconds"]
+		rate = seconds > 0 and stats["bytes"]/1024.0/1024/seconds or 0
+		print "Verified %d files (%d mb) in %.1f s, %.1f mb/s" % (stats["files"],stats["bytes"]/1024/1024,seconds,rate)
+		if stats["mismatches"] != 0:
+			print >> sys.stderr, bad("%d files did not match their hash and were removed" % stats["mismatches"])
+
+	def splitLine(self,line):
+		"""Splits a single line from backup info file into its fields"""
 		# TODO Make generic parse of lines in backup info file
 		s = line.strip().split(",")
 		if len(s) != len(self.backupInfoFields):
 			print >> sys.stderr, red(bold("Syntax error in backup info file: %s" % line))
 			self.abort(1)
-		hash = s[0]
-		filename = s[1]
-		size = s[2]
-		backupSetName = s[3]
-		storedExternally = s[4]
-		mediaTitle = s[5]
-		return s[0],[filename,size,backupSetName,storedExternally,mediaTitle]
+		return s
 		
 	def createLine(self,hash,target):
 		"""Creates a single line for backup info file based upon hash value and filename"""
+		return self.createEntry(hash,target).line()
+
+	def createEntry(self,hash,target):
+		"""Creates a catalog entry for a file copied to target"""
 		stat = os.stat(target)
 		s = path.commonprefix([target,path.join(self.options.destination,self.backupSetName)])
 		filename = target[len(s):].lstrip("/")
-		line = "%s,%s,%s,%s,%s,%s" % (hash,filename,stat.st_size,self.backupSetName,False,"Unknown")
-		return line
+		return CatalogEntry(hash,filename,stat.st_size,self.backupSetName,False,"Unknown")
 		
 	def startBurn(self):
 		print "Starting burn process"
@@ -338,24 +1614,22 @@ class Backup:
 			print >> sys.stderr, red(bold("Directory not found %s" % self.options.destination))
 			self.abort(1)
 		else:
-			if not path.isfile(path.join(self.options.destination,self.options.backup_info_file)):
+			if not path.isfile(path.join(self.options.destination,self.options.backup_info_file)) and not path.isfile(self.getSqliteCatalogFile()):
 				print >> sys.stderr, red(bold("No previous backup found in %s" % self.options.destination))
 				self.abort(1)
-		previousBackupSet = self.getPreviousBackupSet()
+		filesToBeStored = {}
+		for entry in self.catalogEntries(stored=False):
+			if self.includeFile(entry):
+				if not filesToBeStored.has_key(entry.hash):
+					filesToBeStored[entry.hash] = {}
+				filesToBeStored[entry.hash][entry.filename] = entry
 		fileCount = 0
 		totalSize = 0
-		filesToBeStored = {}
-		for hash,entries in previousBackupSet.items():
-			if not filesToBeStored.has_key(hash):
-				filesToBeStored[hash] = []
-			unique = {}
-			for entry in entries:
-				unique[entry[0]] = entry
-			for entry in unique.values():
-				if self.includeFile(entry): 
-					fileCount += 1
-					totalSize += int(entry[self.backupInfoFields.index("filesize")-1])
-					filesToBeStored[hash].append(entry)
+		for hash,unique in filesToBeStored.items():
+			filesToBeStored[hash] = unique.values()
+			for entry in filesToBeStored[hash]:
+				fileCount += 1
+				totalSize += entry.filesize
 		if fileCount == 0:
 			print "No files needs to be backed up"
 			self.abort(0)
@@ -378,35 +1652,41 @@ class Backup:
 		else:
 			self.metadata["medialist"] = self.mediaTitle
 
-		if self.storeFiles(filesToBeStored,previousBackupSet):
-			if not self.options.dry_run:
-				self.storeBackupInfo(previousBackupSet,path.join(self.options.destination,self.options.backup_info_file),backup=True)
-			else:
+		if self.storeFiles(filesToBeStored):
+			if self.options.dry_run:
 				if self.options.verbose: print blue("Skipping write of backup info file " + path.join(self.options.destination,self.options.backup_info_file))
+			elif self.catalog != None:
+				self.catalog.setMetadata("medialist",self.metadata["medialist"])
+				self.catalog.commit()
+			else:
+				records = ["@medium=%s" % self.mediaTitle]
+				for hash,entries in filesToBeStored.items():
+					for entry in entries:
+						records.append("*%s,%s,%s" % (hash,entry.backupset,entry.filename))
+				records.append("%%medialist=%s" % self.metadata["medialist"])
+				self.getJournal().append("burn of %s" % self.mediaTitle,records)
+				self.compactCatalog()
 		else:
 			print >> sys.stderr, red(bold("Unknown error during burn"))
 			self.abort(1)
 		
-	def storeFiles(self,fileList,backupSet):
+	def storeFiles(self,fileList):
 		files = []
 		for hash,entries in fileList.items():
-			es = backupSet[hash]
 			for entry in entries:
-				if not entry in es:
-					print >> sys.stderr, red(bold("Error during backup"))
-					self.abort(1)
-				else:
-					bs = entry[self.backupInfoFields.index("backupset")-1]
-					name = entry[self.backupInfoFields.index("filename")-1]
-					target = name
-					files.append((path.join(bs,name),target))
-					es[es.index(entry)][self.backupInfoFields.index("stored_to_external")-1] = True
-					es[es.index(entry)][self.backupInfoFields.index("media_title")-1] = self.mediaTitle
-		return self.doStore(files,backupSet)
-
-	def doStore(self,files,backupSet):
+				files.append((path.join(entry.backupset,entry.filename),entry.filename))
+				entry.stored_to_external = True
+				entry.media_title = intern(self.mediaTitle)
+				self.storedEntries[(hash,entry.backupset,entry.filename)] = entry
+				if self.catalog != None:
+					self.catalog.markStored(entry)
+		return self.doStore(files)
+
+	def doStore(self,files):
+		import shutil
+		from tempfile import NamedTemporaryFile
 		self.tmpBackupInfoFile = NamedTemporaryFile(mode='wr', bufsize=-1, suffix='', prefix='tmp', dir=None)
-		self.storeBackupInfo(backupSet,self.tmpBackupInfoFile.name,close=False)
+		self.storeBackupInfo(None,self.tmpBackupInfoFile.name,close=False)
 		files.append((self.tmpBackupInfoFile.name,self.options.backup_info_file))
 		## TODO Add thumbnails
 		if self.options.iso:
@@ -458,7 +1738,7 @@ class Backup:
 					os.makedirs(path.dirname(t))
 				if self.options.verbose: print blue("Copy %s -> %s" % (s,t))
 				if self.options.dry_run: continue
-				shutil.copyfile(s,t)
+				copyFile(s,t)
 				if not path.isfile(t):
 					if self.options.verbose: print >> sys.stderr, red(bold("Error creating file %s" % t))
 					if not self.options.verbose: self.o.end(errmsg="Error creating file %s" % t)
@@ -479,26 +1759,26 @@ class Backup:
 		if m:
 			self.progressShower(float(m.groups()[0]))
 		
-	def storeBackupInfo(self,backupSet,file,close=True,backup=False):
+	def storeBackupInfo(self,backupSet,file,close=True):
 		"""Stores backupSet in backup info file"""
 		self.metadata["version"] = VERSION
-		header = self.createHeader()
-		lines = []
-		for hash,entries in backupSet.items():
-			for entry in entries:
-				s = hash
-				for e in entry:
-					s += ","+e.__str__()
-				s += "\n"
-				lines.append(s)
-
-		##f = open("temp","w")
-		if backup:
-			shutil.copyfile(file,file+"~")
 		if self.options.verbose: print blue("Storing backup info file " + file)
 		f = open(file,"w")
-		f.write(header)
-		f.writelines(lines)
+		f.write(self.createHeader())
+		if self.catalog != None:
+			for entry in self.catalog.select("ORDER BY id"):
+				f.write(entry.line()+"\n")
+		elif backupSet == None:
+			for s in self.catalogRows(self.getBackupInfoFile(),metadata=False):
+				entry = self.storedEntries.get((s[0],s[3],s[1]))
+				if entry != None:
+					f.write(entry.line()+"\n")
+				else:
+					f.write(",".join(s)+"\n")
+		else:
+			for hash,entries in backupSet.items():
+				for entry in entries:
+					f.write(entry.line()+"\n")
 		f.flush()
 		if close: f.close()
 
@@ -510,7 +1790,7 @@ class Backup:
 		
 	def includeFile(self,entry):
 		include = True
-		if entry[self.backupInfoFields.index("stored_to_external")-1] == "True":
+		if entry.stored_to_external:
 			include = False
 		if include and self.options.range != "all":
 			if not self.__dict__.has_key("_range_groups"):
@@ -557,7 +1837,7 @@ class Backup:
 				self._range_max = self._range_from_date
 				self._range_min = self._range_to_date
 				
-			filename = path.basename(entry[self.backupInfoFields.index("filename")-1])
+			filename = path.basename(entry.filename)
 			m = RANGE_FILENAME.search(filename)
 			if m:
 				#datetime(  	year, month, day[, hour[, minute[, second[, microsecond[, tzinfo]]]]])
@@ -584,25 +1864,143 @@ class Backup:
 		self.o.setProgress(int(progress))
 		self.o.update()
 		
+	def lookup(self):
+		"""Prints where the files, directories and md5 hashes given after dst are stored"""
+		if not path.isdir(self.options.destination):
+			print >> sys.stderr, red(bold("Directory not found %s" % self.options.destination))
+			self.abort(1)
+		# Lookups never write to the destination, the catalog must exist already
+		sqlite = self.useSqliteCatalog()
+		if sqlite:
+			catalogFile = self.getSqliteCatalogFile()
+		else:
+			catalogFile = path.join(self.options.destination,self.options.backup_info_file)
+		if not path.isfile(catalogFile):
+			print >> sys.stderr, bad("No catalog found in %s" % self.options.destination)
+			self.abort(1)
+		queries = {}
+		files = []
+		for target in self.options.lookup_targets:
+			if path.isdir(target):
+				for dirname,entries in walkSource(path.abspath(target),self.options.follow_symlinks):
+					files.extend([filename for filename,st in entries])
+			elif path.isfile(target):
+				files.append(target)
+			elif RAW_HASH.match(target):
+				queries.setdefault(target.lower(),[]).append(target)
+			else:
+				print >> sys.stderr, bad("Could not find %s" % target)
+		if len(files) > 0:
+			self.o.setMax(len(files))
+			self.o.begin("Hashing %d files..." % len(files))
+			progress = 0
+			for filename,hash,error in self.hashFiles(files):
+				progress += 1
+				self.o.setProgress(progress)
+				self.o.update()
+				if error != None:
+					print >> sys.stderr, bad("\nCould not read %s: %s" % (filename,error))
+				else:
+					queries.setdefault(hash,[]).append(filename)
+			self.o.end()
+		mapped = None
+		if sqlite:
+			index = self.getPreviousBackupSet()
+			find = lambda hash: index.get(hash,[])
+		else:
+			mapped = self.openMappedCatalog(catalogFile,readOnly=True)
+			find = lambda hash: [CatalogEntry(s[0],s[1],int(s[2]),s[3],s[4] == "True",s[5]) for s in mapped.lookup(hash)]
+		found = 0
+		results = []
+		for hash in sorted(queries.keys()):
+			entries = find(hash)
+			if len(entries) > 0: found += len(queries[hash])
+			for name in queries[hash]:
+				results.append((name,hash,entries))
+		results.sort()
+		for name,hash,entries in results:
+			if len(entries) == 0:
+				print warn("Not found:"), "%s (%s)" % (name,hash)
+				continue
+			print "%s (%s)" % (name,hash)
+			for entry in entries:
+				if entry.stored_to_external:
+					print '\t%s stored on "%s"' % (path.join(entry.backupset,entry.filename),entry.media_title)
+				else:
+					print "\t%s not stored externally" % path.join(entry.backupset,entry.filename)
+		print "%d of %d lookups found in catalog" % (found,len(results))
+		if mapped != None: mapped.close()
+
+	def hashFiles(self,files):
+		"""Yields (filename,hash,error) for files, hashing them on a pool of workers"""
+		jobs = self.options.jobs
+		if jobs <= 0: jobs = defaultJobs(path.dirname(path.abspath(files[0])))
+		hashCache = self.openHashCache()
+		if jobs > 1 and len(files) > 1:
+			pool = HashPool(jobs,self.options.job_type)
+		else:
+			pool = None
+		stats = {}
+		for filename in files:
+			try:
+				st = os.stat(filename)
+			except OSError, e:
+				yield filename,None,e.strerror
+				continue
+			hash = hashCache != None and hashCache.lookup(st) or None
+			if hash != None:
+				yield filename,hash,None
+			elif pool != None:
+				stats[filename] = st
+				pool.submit(filename)
+			else:
+				try:
+					hash = self.getHash(filename)
+				except IOError, e:
+					yield filename,None,e.strerror
+					continue
+				if hashCache != None: hashCache.store(st,hash)
+				yield filename,hash,None
+			if pool != None:
+				for result in pool.completed():
+					if result[1] != None and hashCache != None: hashCache.store(stats[result[0]],result[1])
+					yield result
+		if pool != None:
+			for result in pool.completed(block=True):
+				if result[1] != None and hashCache != None: hashCache.store(stats[result[0]],result[1])
+				yield result
+			pool.close()
+		if hashCache != None: hashCache.close()
+
+	def mappedEntries(self,mapped):
+		"""Yields the entries of a mapped catalog one backupset at a time"""
+		for name in sorted(mapped.backupsets()):
+			for s in mapped.backupsetRows(name):
+				yield CatalogEntry(s[0],s[1],int(s[2]),s[3],s[4] == "True",s[5])
+		mapped.close()
+
 	def createThumbnails(self):
 		"""Creates thumbnails for all existing images"""
-		backupSet = self.getPreviousBackupSet()
+		import commands
+		if self.useSqliteCatalog():
+			entries = self.catalogEntries(self.getPreviousBackupSet())
+		else:
+			mapped = self.openMappedCatalog(self.getBackupInfoFile())
+			self.backupSetSize = mapped.count()
+			entries = self.mappedEntries(mapped)
 		progress = 0
 		self.o.setMax(self.backupSetSize)
 		self.o.begin("Creating thumbnails")
-		for hash,entries in backupSet.items():
-			for entry in entries:
-				progress += 1
-				self.o.setProgress(progress)
-				self.o.update()
-				filename = entry[self.backupInfoFields.index("filename")-1]
-				backupSetName = entry[self.backupInfoFields.index("backupset")-1]
-				source = path.join(path.join(self.options.destination,backupSetName),filename)
-				target = path.join(self.options.thumbnail_directory,filename)
-				if not path.isfile(source): continue
-				if not path.isdir(path.dirname(target)): os.makedirs(path.dirname(target))
-				cmd = '%s -f -l "%s" -et "%s"' % (self.thumbnailCommand,path.dirname(target),source)
-				commands.getoutput(cmd)
+		for entry in entries:
+			progress += 1
+			self.o.setProgress(progress)
+			self.o.update()
+			source = path.join(self.options.destination,entry.backupset,entry.filename)
+			target = path.join(self.options.thumbnail_directory,entry.filename)
+			if not path.isfile(source): continue
+			if not path.isdir(path.dirname(target)): os.makedirs(path.dirname(target))
+			cmd = '%s -f -l "%s" -et "%s"' % (self.thumbnailCommand,path.dirname(target),source)
+			commands.getoutput(cmd)
 		self.o.end()
 		
 	def printStatistics(self):
@@ -622,43 +2020,48 @@ class Backup:
 					print """Backup set "%s" contains %d (%d mb) files locally and %d (%d mb) files externally""" % (key,totalCount,(totalSize/1024/1024),storedCount,(storedSize/1024/1024))
 		
 	def getStatistics(self):
-		backupSet = self.getPreviousBackupSet()
+		if self.useSqliteCatalog():
+			self.getPreviousBackupSet()
+			return self.getCatalogStatistics()
 		statistics = {}
-		for hash,entries in backupSet.items():
-			for entry in entries:
-				filename = entry[self.backupInfoFields.index("filename")-1]
-				backupSet = entry[self.backupInfoFields.index("backupset")-1]
-				mediaTitle = entry[self.backupInfoFields.index("media_title")-1]
-				stored = entry[self.backupInfoFields.index("stored_to_external")-1]
-				filesize = int(entry[self.backupInfoFields.index("filesize")-1])
-				target = path.join(self.options.destination,path.join(backupSet,filename))
-				if not statistics.has_key(mediaTitle):
-					statistics[mediaTitle] = (0,0,0,0)
-				totalCount,storedCount,totalSize,storedSize = statistics[mediaTitle]
-				if path.isfile(target):
-					totalCount = totalCount+1
-					totalSize = totalSize+filesize
-				if stored: 
-					storedCount += 1
-					storedSize += filesize				
-				
-				statistics[mediaTitle] = (totalCount,storedCount,totalSize,storedSize)
+		for entry in self.catalogEntries():
+			mediaTitle = entry.media_title
+			filesize = entry.filesize
+			target = path.join(self.options.destination,entry.backupset,entry.filename)
+			if not statistics.has_key(mediaTitle):
+				statistics[mediaTitle] = (0,0,0,0)
+			totalCount,storedCount,totalSize,storedSize = statistics[mediaTitle]
+			if path.isfile(target):
+				totalCount = totalCount+1
+				totalSize = totalSize+filesize
+			if entry.stored_to_external:
+				storedCount += 1
+				storedSize += filesize				
+			
+			statistics[mediaTitle] = (totalCount,storedCount,totalSize,storedSize)
+		return statistics
+
+	def getCatalogStatistics(self):
+		"""Statistics from the SQLite catalog"""
+		statistics = {}
+		for mediaTitle,count,size,storedCount,storedSize in self.catalog.statistics():
+			statistics[mediaTitle] = (0,storedCount,0,storedSize)
+		for entry in self.catalog.select():
+			target = path.join(self.options.destination,entry.backupset,entry.filename)
+			if path.isfile(target):
+				totalCount,storedCount,totalSize,storedSize = statistics[entry.media_title]
+				statistics[entry.media_title] = (totalCount+1,storedCount,totalSize+entry.filesize,storedSize)
 		return statistics
 	
 	def clean(self):
-		backupSet = self.getPreviousBackupSet()
 		filesToDelete = {}
-		for hash,entries in backupSet.items():
-			for entry in entries:
-				filename = entry[self.backupInfoFields.index("filename")-1]
-				backupSet = entry[self.backupInfoFields.index("backupset")-1]
-				mediaTitle = entry[self.backupInfoFields.index("media_title")-1]
-				stored = entry[self.backupInfoFields.index("stored_to_external")-1]
-				target = path.join(self.options.destination,path.join(backupSet,filename))
-				if stored == "True" and path.isfile(target):
-					if not filesToDelete.has_key(mediaTitle):
-						filesToDelete[mediaTitle] = []
-					filesToDelete[mediaTitle].append(target)
+		for entry in self.catalogEntries(stored=True):
+			mediaTitle = entry.media_title
+			target = path.join(self.options.destination,entry.backupset,entry.filename)
+			if path.isfile(target):
+				if not filesToDelete.has_key(mediaTitle):
+					filesToDelete[mediaTitle] = []
+				filesToDelete[mediaTitle].append(target)
 		always = False
 		if len(filesToDelete) == 0:
 			print "Found no files to be deleted"
@@ -679,17 +2082,44 @@ class Backup:
 					os.remove(f)
 					
 	def undo(self):
+		import shutil
 		t = path.join(self.options.destination,self.options.backup_info_file)
 		s = t+"~"
+		if self.useSqliteCatalog():
+			self.undoSqliteCatalog()
+			return
+		journal = self.getJournal()
+		offset,label = journal.lastChange()
+		if label != None:
+			answer = raw_input(red("Do you really want to undo the %s? [y/N] " % label))
+			if answer in ("y","Y"):
+				journal.undo()
+			return
+		if not path.isfile(s):
+			print bad("No undo information available!")
+			self.abort(1)
 		answer = raw_input(red("Do you really want to undo? [y/N] "))
 		if answer in ("y","Y"):
-			if path.isfile(t):
-				shutil.copyfile(s,t)
-			else:
-				print bad("No undo information available!")
-				self.abort(1)
+			shutil.copyfile(s,t)
 				
+	def undoSqliteCatalog(self):
+		"""Undoes the last burn in the SQLite catalog by unmarking the files of the last medium"""
+		self.getPreviousBackupSet()
+		if not self.metadata.has_key("medialist"):
+			print bad("No undo information available!")
+			self.abort(1)
+		medialist = self.metadata["medialist"].split(",")
+		answer = raw_input(red("Do you really want to undo the burn of %s? [y/N] " % medialist[0]))
+		if answer in ("y","Y"):
+			self.catalog.unmarkStored(medialist[0])
+			if len(medialist) > 1:
+				self.catalog.setMetadata("medialist",",".join(medialist[1:]))
+			else:
+				self.catalog.deleteMetadata("medialist")
+			self.catalog.commit()
+
 def runCmd(cmd,callback):
+	import popen2
 	child = popen2.Popen3(cmd, True)
 	#print 'Running: [%d] %s' % (child.pid,cmd)
 	#args['pids-to-kill'].append((child.pid,cmd))
@@ -723,6 +2153,232 @@ def runCmd(cmd,callback):
 	#print errors
 	#print lines
 
+def walkSource(top,followSymlinks=False):
+	"""Walks top and yields (dirname,files) for every directory"""
+	st = os.stat(top)
+	visited = set([(st.st_dev,st.st_ino)])
+	pending = [top]
+	while pending:
+		dirname = pending.pop()
+		try:
+			entries = listDirectory(dirname)
+		except OSError, e:
+			print >> sys.stderr, bad("Could not read directory %s: %s" % (dirname,e.strerror))
+			continue
+		files = []
+		subdirs = []
+		for filename,kind,st in entries:
+			if kind == "link":
+				try:
+					st = os.stat(filename)
+				except OSError:
+					continue
+				if stat.S_ISDIR(st.st_mode) and followSymlinks: kind = "dir"
+				elif stat.S_ISREG(st.st_mode): kind = "file"
+				else: continue
+			if kind == "dir":
+				if followSymlinks:
+					if st == None: st = os.stat(filename)
+					if (st.st_dev,st.st_ino) in visited: continue
+					visited.add((st.st_dev,st.st_ino))
+				subdirs.append(filename)
+			elif kind == "file":
+				if st == None: st = os.lstat(filename)
+				files.append((filename,st))
+		yield dirname,files
+		subdirs.reverse()
+		pending.extend(subdirs)
+
+def sampleDigest(filename,size):
+	"""md5 of the first and last SAMPLE_SIZE bytes of filename"""
+	import hashlib
+	md5 = hashlib.md5()
+	f = open(filename,"rb")
+	try:
+		md5.update(f.read(SAMPLE_SIZE))
+		f.seek(max(size-SAMPLE_SIZE,0))
+		md5.update(f.read(SAMPLE_SIZE))
+	finally:
+		f.close()
+	return md5.digest()
+
+def mtimeNs(st):
+	"""Modification time of st in nanoseconds"""
+	if hasattr(st,"st_mtime_ns"): return st.st_mtime_ns
+	return int(st.st_mtime*1000000000)
+
+def defaultJobs(directory):
+	"""Number of hash workers to use when --jobs is not given"""
+	import multiprocessing
+	try:
+		cores = multiprocessing.cpu_count()
+	except NotImplementedError:
+		cores = 1
+	if isRotational(directory): return 1
+	return cores
+
+def copyFile(source,target,buffer=None):
+	"""Copies source to target along the cheapest path available"""
+	src = os.open(source,os.O_RDONLY)
+	try:
+		dst = os.open(target,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0666)
+		try:
+			if reflink(src,dst): return "reflink"
+			offset = 0
+			for method in ("copy_file_range","sendfile"):
+				offset,done = kernelCopy(method,src,dst,offset)
+				if done: return method
+			os.lseek(src,offset,0)
+			os.lseek(dst,offset,0)
+			if buffer == None: buffer = bytearray(HASH_BUFFER_SIZE)
+			view = memoryview(buffer)
+			srcFile = io.open(src,"rb",buffering=0,closefd=False)
+			while True:
+				n = srcFile.readinto(buffer)
+				if not n: break
+				written = 0
+				while written < n:
+					written += os.write(dst,view[written:n])
+			return "read"
+		finally:
+			os.close(dst)
+	finally:
+		os.close(src)
+
+def reflink(src,dst):
+	"""Makes the file descriptor dst share the extents of src"""
+	try:
+		fcntl.ioctl(dst,FICLONE,src)
+		return True
+	except IOError:
+		return False
+
+_libc = None
+
+def libc():
+	import ctypes, ctypes.util
+	global _libc
+	if _libc == None:
+		_libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+	return _libc
+
+def fsyncPath(name):
+	"""Writes back the file or directory name"""
+	fd = os.open(name,os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def syncFileSystem(directory):
+	"""Writes back the file system holding directory"""
+	try:
+		call = libc().syncfs
+	except AttributeError:
+		return False
+	fd = os.open(directory,os.O_RDONLY)
+	try:
+		return call(fd) == 0
+	finally:
+		os.close(fd)
+
+def dropCache(fd):
+	"""Writes back fd and drops it from the page cache"""
+	import ctypes
+	os.fdatasync(fd)
+	try:
+		fadvise = libc().posix_fadvise
+	except AttributeError:
+		return False
+	return fadvise(fd,ctypes.c_longlong(0),ctypes.c_longlong(0),POSIX_FADV_DONTNEED) == 0
+
+def kernelCopy(method,src,dst,offset):
+	"""Copies src from offset into dst with copy_file_range or sendfile"""
+	import ctypes, errno
+	try:
+		call = getattr(libc(),method)
+	except AttributeError:
+		return offset,False
+	call.restype = ctypes.c_ssize_t
+	position = ctypes.c_longlong(offset)
+	if method == "sendfile":
+		os.lseek(dst,offset,0)
+	while True:
+		if method == "copy_file_range":
+			target = ctypes.c_longlong(position.value)
+			n = call(src,ctypes.byref(position),dst,ctypes.byref(target),ctypes.c_size_t(COPY_CHUNK_SIZE),0)
+		else:
+			n = call(dst,src,ctypes.byref(position),ctypes.c_size_t(COPY_CHUNK_SIZE))
+		if n == 0:
+			return position.value,True
+		if n < 0:
+			e = ctypes.get_errno()
+			if e == errno.EINTR: continue
+			if e in (errno.ENOSYS,errno.EXDEV,errno.EINVAL,errno.EOPNOTSUPP,errno.EBADF,errno.ETXTBSY,errno.EPERM):
+				return position.value,False
+			raise IOError(e,os.strerror(e))
+
+def defaultCopyJobs(source,destination):
+	"""Number of copy workers to use when --copy-jobs is not given"""
+	if isRotational(source) or isRotational(destination): return 2
+	return max(4,defaultJobs(source))
+
+def makeDirectories(directories,known):
+	"""Creates directories, parents first, skipping those in known"""
+	import errno
+	for directory in sorted(set([path.normpath(d) for d in directories])):
+		missing = []
+		while directory and not directory in known:
+			missing.append(directory)
+			parent = path.dirname(directory)
+			if parent == directory: break
+			directory = parent
+		for directory in reversed(missing):
+			try:
+				os.mkdir(directory)
+			except OSError, e:
+				if e.errno != errno.EEXIST or not path.isdir(directory): raise
+			known.add(directory)
+
+def isRotational(directory):
+	"""Returns True if directory is stored on a rotational block device"""
+	try:
+		dev = os.stat(directory).st_dev
+	except OSError:
+		return False
+	sysfs = "/sys/dev/block/%d:%d" % (os.major(dev),os.minor(dev))
+	for queue in (path.join(sysfs,"queue"),path.join(sysfs,"..","queue")):
+		try:
+			return open(path.join(queue,"rotational")).read().strip() == "1"
+		except IOError:
+			continue
+	return False
+
+def listDirectory(dirname):
+	"""Returns (filename,kind,stat) for every entry in dirname"""
+	entries = []
+	if scandir != None:
+		for entry in scandir(dirname):
+			if entry.is_symlink(): kind = "link"
+			elif entry.is_dir(): kind = "dir"
+			elif entry.is_file(): kind = "file"
+			else: kind = None
+			entries.append((entry.path,kind,None))
+	else:
+		for name in os.listdir(dirname):
+			filename = path.join(dirname,name)
+			try:
+				st = os.lstat(filename)
+			except OSError:
+				continue
+			if stat.S_ISLNK(st.st_mode): kind = "link"
+			elif stat.S_ISDIR(st.st_mode): kind = "dir"
+			elif stat.S_ISREG(st.st_mode): kind = "file"
+			else: kind = None
+			entries.append((filename,kind,st))
+	entries.sort()
+	return entries
+
 def makeNonBlocking(fd):
 	fl = fcntl.fcntl(fd, fcntl.F_GETFL)
 	try:
@@ -735,7 +2391,34 @@ def fixNumber(number,default=0):
 	if number == None: return default
 	else: return int(number)
 
+def which(command):
+	"""Returns the full path of command if it is found in PATH, otherwise None"""
+	for directory in os.environ.get("PATH",os.defpath).split(os.pathsep):
+		filename = path.join(directory,command)
+		if path.isfile(filename) and os.access(filename,os.X_OK):
+			return filename
+	return None
+
+def readLineBlocks(f,blockSize=CATALOG_BLOCK_SIZE):
+	"""Yields the lines of f in lists, reading blocks of blockSize bytes"""
+	rest = ""
+	while True:
+		block = f.read(blockSize)
+		if block == "": break
+		lines = (rest+block).split("\n")
+		rest = lines.pop()
+		yield lines
+	if rest != "":
+		yield [rest]
+
+def newJournalId():
+	"""Returns a random id for a new catalog journal"""
+	import binascii
+	return binascii.hexlify(os.urandom(8))
+
 def update(opt, value, parser, *args, **kwargs):
+	import shutil
+	import urllib, commands
 	print "Checking %s for updates..." % UPDATE_URL
 	res = urllib.urlopen(UPDATE_URL)
 	lines = res.readlines()
@@ -921,6 +2604,7 @@ class OutputText(Output):
 		self.errstatus = None
 		self.errmsg = None
 		self.title = msg
+		self._max_width = None
 		self.update()
         
 	def end(self, errno=0, errmsg=None):
@@ -977,19 +2661,23 @@ class OutputText(Output):
 			self.error(self.errmsg, False)
 
 	def _getMaxWidth(self):
-		##if self._max_width != None: return self._max_width
+		if self._max_width != None: return self._max_width
 		lines = os.popen("stty size 2>/dev/null").readlines()
 		if lines == []:
-			return 80
+			self._max_width = 80
 		else:
-			return int(lines[0].split()[1])
+			self._max_width = int(lines[0].split()[1])
+		return self._max_width
 
 def main():
 	parser = optparse.OptionParser(usage="usage: %prog [options] dst",version="%%prog %s" % VERSION)
 	parser.add_option("-v","--verbose",action="store_true",default=False,help="Enables more verbose output during backup")
 	parser.add_option("-s","--source",metavar="DIR",help="User DIR as source for the backup process. Default is to use the current directory",default="./")
-	parser.add_option("--verify",action="store_true",default=False,help="Verify that files are copied. This could slow down the backup considerably")
+	parser.add_option("--verify",action="store_true",default=False,help="Verify copied files by reading them back from disk, bypassing the page cache, while the backup proceeds")
 	parser.add_option("-i","--images",action="store_true",default=False,help="Only backup image files [jpg,jpeg,cr2,tif,tiff]")
+	parser.add_option("-j","--jobs",type="int",default=0,metavar="N",help="Hash source files with N parallel workers. Default is one per core, or one for rotational disks")
+	parser.add_option("--copy-jobs",type="int",default=0,metavar="N",help="Copy files with N parallel workers. Default is four or one per core, or two for rotational disks")
+	parser.add_option("--classify",type="choice",choices=["extension","magic"],default="extension",help="How --images decides what is an image: trust known file extensions and only sniff unknown ones, or sniff every file. Default is [extension]")
 	parser.add_option("-c","--clean",action="store_true",default=False,help="Removes all files stored on external media")
 	parser.add_option("--statistics",action="store_true",default=False,help="Prints some statistics for the specified backup set")
 
@@ -1001,6 +2689,9 @@ def main():
 	parser.add_option_group(ext_group)
 	
 	adv_group = optparse.OptionGroup(parser,"Advanced Options", "")
+	adv_group.add_option("--catalog",type="choice",choices=["text","sqlite"],default=None,help="Keep the catalog in the backup info file or in an indexed SQLite database next to it. The database is created from the backup info file on first use. Default is to use the database if it exists")
+	adv_group.add_option("--durability",type="choice",choices=["none","batch","file"],default="batch",help="When copied files and catalog rows are written to disk: none leaves it to the operating system, batch syncs the destination once per group of rows before committing them, file syncs every file and commits its row on its own. Default is [batch]")
+	adv_group.add_option("--export-catalog",default=None,metavar="FILE",help="Export the SQLite catalog to FILE in the backup info file format")
 	adv_group.add_option("--backup-info-file",default="backup.info",metavar="NAME",help="Use NAME as backup info file. Default is [backup.info]")
 	adv_group.add_option("--only-hash",action="store_true",default=False,help="Dont do backup of identical files with differing file namse")
 	adv_group.add_option("--dry-run",action="store_true",default=False,help="Dont do the actual copying")
@@ -1008,7 +2699,10 @@ def main():
 	adv_group.add_option("--no-thumbnails",action="store_false",default=True,dest="thumbnails",help="Don't store thumbnails")
 	adv_group.add_option("--thumbnail-directory",default="Thumbnails",metavar="DIR",help="Specify thumbnail directory DIR. Default is [Thumbnails]")
 	adv_group.add_option("--create-thumbnails",action="store_true",default=False,help="Creates thumbnails for existing backup set")
-	adv_group.add_option("--lookup",action="store_true",default=False,help="If specified all arguments specified at the end of the command line is threated as lookup targets")
+	adv_group.add_option("--lookup",action="store_true",default=False,help="If specified all arguments specified after dst are threated as lookup targets: files, directories or md5 hashes. Prints the backupset, path and media of every match")
+	adv_group.add_option("--no-hash-cache",action="store_false",default=True,dest="hash_cache",help="Don't use or update the persistent source hash cache")
+	adv_group.add_option("--job-type",type="choice",choices=["thread","process"],default="thread",help="Run hash workers as threads or processes. Default is [thread]")
+	adv_group.add_option("--follow-symlinks",action="store_true",default=False,help="Follow symbolic links to directories when scanning the source")
 	adv_group.add_option("--debug",action="store_true",default=False,help="Enable debug mode")
 	parser.add_option_group(adv_group)
 	
@@ -1028,6 +2722,7 @@ def main():
 				print >> sys.stderr, bad("Range has syntax errors")
 				sys.exit(1)
 		options.destination = args[0]
+		options.lookup_targets = args[1:]
 		backup = Backup(options)
 	
 if __name__ == "__main__": main()
@@ -22,6 +22,10 @@ information about the format of these files.
 import os
 import stat
 import fnmatch
+import marshal
+import re
+from binascii import hexlify
+from cStringIO import StringIO
 
 import xdg.BaseDirectory
 import xdg.Locale
@@ -37,6 +41,14 @@ globs = None    # List of (glob, type) pairs
 literals = None # Maps liternal names to types
 magic = None
 
+# Version of the compiled database snapshot written to the cache directory
+SNAPSHOT_VERSION = 1
+
+# Name matchers compiled from exts and globs by _compile_names()
+_ext_trie = None    # Reversed extensions as nested dicts, None keys hold the type
+_glob_res = None    # List of (regex, offset) matching chunks of globs in order
+_GLOB_CHUNK = 90    # Patterns per regex, the re module supports 100 groups
+
 def _get_node_data(node):
     """Get text of XML node"""
     return ''.join([n.nodeValue for n in node.childNodes]).strip()
@@ -91,9 +103,11 @@ class MIMEtype:
         return '[%s: %s]' % (self, self._comment or '(comment not loaded)')
 
 class MagicRule:
-    def __init__(self, f):
+    def __init__(self, f=None):
         self.next=None
         self.prev=None
+        if f is None:
+            return
 
         #print line
         ind=''
@@ -155,6 +169,23 @@ class MagicRule:
         if c!='\n':
             raise 'Malformed MIME magic line'
 
+        self._compile()
+
+    def _compile(self):
+        "Precomputes the masked comparison as integers, so a mask applies to the whole value at once."
+        if self.mask:
+            self._mask_int=int(hexlify(self.mask) or '0', 16)
+            self._value_int=int(hexlify(self.value) or '0', 16)
+
+    def indexKey(self):
+        """Returns (offset, first byte) that a buffer must have to match this rule,
+        or None if the rule can match more than one offset or has a masked first byte."""
+        if self.range!=1 or not self.lenvalue:
+            return None
+        if self.mask and self.mask[0]!='\xff':
+            return None
+        return (self.start, self.value[0])
+
     def getLength(self):
         return self.start+self.lenvalue+self.range
 
@@ -173,21 +204,18 @@ class MagicRule:
             return True
 
     def match0(self, buffer):
+        if not self.mask:
+            if self.range==1:
+                return buffer[self.start:self.start+self.lenvalue]==self.value
+            return buffer.find(self.value, self.start,
+                               self.start+self.range-1+self.lenvalue)>=0
         l=len(buffer)
         for o in range(self.range):
             s=self.start+o
             e=s+self.lenvalue
             if l<e:
                 return False
-            if self.mask:
-                test=''
-                for i in range(self.lenvalue):
-                    c=ord(buffer[s+i]) & ord(self.mask[i])
-                    test+=chr(c)
-            else:
-                test=buffer[s:e]
-
-            if test==self.value:
+            if int(hexlify(buffer[s:e]) or '0', 16) & self._mask_int==self._value_int:
                 return True
 
     def __repr__(self):
@@ -222,6 +250,17 @@ class MagicType:
             if rule.match(buffer):
                 return self.mtype
 
+    def indexKeys(self):
+        """Returns the index keys of all top level rules, or None if any of them
+        can not be indexed and the type must always be tried."""
+        keys=[]
+        for rule in self.top_rules:
+            key=rule.indexKey()
+            if key is None:
+                return None
+            keys.append(key)
+        return keys
+
     def __repr__(self):
         return '<MagicType %s>' % self.mtype
     
@@ -229,9 +268,11 @@ class MagicDB:
     def __init__(self):
         self.types={}   # Indexed by priority, each entry is a list of type rules
         self.maxlen=0
+        self._index=None
 
     def mergeFile(self, fname):
-        f=file(fname, 'r')
+        self._index=None
+        f=StringIO(file(fname, 'rb').read())
         line=f.readline()
         if line!='MIME-Magic\0\n':
             raise 'Not a MIME magic file'
@@ -274,17 +315,47 @@ class MagicDB:
             if not c:
                 break
 
-    def match_data(self, data, max_pri=100, min_pri=0):
+    def _compile(self):
+        """Builds the match index: priorities sorted once, and for each priority a
+        table from (offset, first byte) to the types that can match it. Types with
+        rules that can not be indexed are always tried."""
+        index=[]
         pris=self.types.keys()
-        pris.sort(lambda a, b: -cmp(a, b))
+        pris.sort(reverse=True)
         for pri in pris:
-            #print pri, max_pri, min_pri
+            table={}
+            always=[]
+            for i, type in enumerate(self.types[pri]):
+                keys=type.indexKeys()
+                if keys is None:
+                    always.append(i)
+                    continue
+                for key in keys:
+                    table.setdefault(key, []).append(i)
+            starts=list(set([key[0] for key in table]))
+            starts.sort()
+            index.append((pri, table, starts, always))
+        self._index=index
+
+    def match_data(self, data, max_pri=100, min_pri=0):
+        if self._index is None:
+            self._compile()
+        l=len(data)
+        for pri, table, starts, always in self._index:
             if pri>max_pri:
                 continue
             if pri<min_pri:
                 break
-            for type in self.types[pri]:
-                m=type.match(data)
+            candidates=set(always)
+            for start in starts:
+                if start>=l:
+                    break
+                candidates.update(table.get((start, data[start]), ()))
+            if not candidates:
+                continue
+            types=self.types[pri]
+            for i in sorted(candidates):
+                m=types[i].match(data)
                 if m:
                     return m
         
@@ -298,8 +369,51 @@ class MagicDB:
 
         return None
     
+    def dump(self):
+        """Returns the database as plain data for a snapshot: a dict from priority to a
+        list of (type name, rule chains), each chain a list of rule tuples."""
+        data={}
+        for pri, ents in self.types.items():
+            data[pri]=[(str(t.mtype), [_dump_chain(r) for r in t.top_rules]) for t in ents]
+        return data
+
+    def load(self, data, maxlen):
+        "Loads the database from the plain data returned by dump()."
+        self.types={}
+        self.maxlen=maxlen
+        self._index=None
+        for pri, ents in data.items():
+            self.types[pri]=[]
+            for tname, chains in ents:
+                magictype=MagicType(lookup(tname))
+                for chain in chains:
+                    magictype.top_rules.append(_load_chain(chain))
+                self.types[pri].append(magictype)
+
     def __repr__(self):
         return '<MagicDB %s>' % self.types
+
+def _dump_chain(rule):
+    chain=[]
+    while rule:
+        chain.append((rule.nest, rule.start, rule.value, rule.mask, rule.word, rule.range))
+        rule=rule.next
+    return chain
+
+def _load_chain(chain):
+    first=prev=None
+    for nest, start, value, mask, word, range in chain:
+        rule=MagicRule()
+        rule.nest, rule.start, rule.value, rule.mask, rule.word, rule.range=nest, start, value, mask, word, range
+        rule.lenvalue=len(value)
+        rule._compile()
+        if prev:
+            prev.next=rule
+            rule.prev=prev
+        else:
+            first=rule
+        prev=rule
+    return first
             
 
 # Some well-known types
@@ -315,11 +429,82 @@ app_exe = lookup('application', 'executable')
 
 _cache_uptodate = False
 
+def _database_sources():
+    """Returns (path, mtime, size) of every globs and magic file the database is built from."""
+    sources = []
+    for name in ('globs', 'magic'):
+        for path in xdg.BaseDirectory.load_data_paths(os.path.join('mime', name)):
+            st = os.stat(path)
+            sources.append((path, st.st_mtime, st.st_size))
+    return sources
+
+def _snapshot_path():
+    return os.path.join(xdg.BaseDirectory.xdg_cache_home, 'pyxdg', 'mime-database')
+
+def _load_snapshot(sources):
+    """Loads the compiled database from the cache directory. Returns False if there is
+    no snapshot or it was built from other versions of the source files."""
+    global exts, globs, literals, magic
+    try:
+        f = file(_snapshot_path(), 'rb')
+        try:
+            data = marshal.load(f)
+        finally:
+            f.close()
+        version, snapshot_sources, snapshot_exts, snapshot_globs, snapshot_literals, maxlen, snapshot_magic = data
+    except (IOError, EOFError, ValueError, TypeError):
+        return False
+    if version != SNAPSHOT_VERSION or snapshot_sources != sources:
+        return False
+    exts = {}
+    for ext, tname in snapshot_exts.items():
+        exts[ext] = lookup(tname)
+    globs = [(pattern, lookup(tname)) for pattern, tname in snapshot_globs]
+    literals = {}
+    for name, tname in snapshot_literals.items():
+        literals[name] = lookup(tname)
+    magic = MagicDB()
+    magic.load(snapshot_magic, maxlen)
+    return True
+
+def _save_snapshot(sources):
+    """Writes the compiled database to the cache directory, ignoring any errors."""
+    snapshot_exts = {}
+    for ext, mtype in exts.items():
+        snapshot_exts[ext] = str(mtype)
+    snapshot_globs = [(pattern, str(mtype)) for pattern, mtype in globs]
+    snapshot_literals = {}
+    for name, mtype in literals.items():
+        snapshot_literals[name] = str(mtype)
+    data = (SNAPSHOT_VERSION, sources, snapshot_exts, snapshot_globs,
+            snapshot_literals, magic.maxlen, magic.dump())
+    path = _snapshot_path()
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = file(tmp, 'wb')
+        try:
+            marshal.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
 def _cache_database():
     global exts, globs, literals, magic, _cache_uptodate
 
     _cache_uptodate = True
 
+    sources = _database_sources()
+    if _load_snapshot(sources):
+        _compile_names()
+        return
+
     exts = {}       # Maps extensions to types
     globs = []      # List of (glob, type) pairs
     literals = {}   # Maps liternal names to types
@@ -352,6 +537,55 @@ def _cache_database():
     # Sort globs by length
     globs.sort(lambda a, b: cmp(len(b[0]), len(a[0])))
 
+    _save_snapshot(sources)
+    _compile_names()
+
+def _compile_names():
+    """Compiles exts into a trie of reversed extensions and globs into alternation
+    regexes, so a leaf name is classified without looping over the tables."""
+    global _ext_trie, _glob_res
+
+    _ext_trie = {}
+    for ext, mtype in exts.items():
+        node = _ext_trie
+        for c in reversed(ext):
+            node = node.setdefault(c, {})
+        node[None] = mtype
+
+    _glob_res = []
+    for offset in range(0, len(globs), _GLOB_CHUNK):
+        patterns = []
+        for glob, mtype in globs[offset:offset + _GLOB_CHUNK]:
+            pattern = fnmatch.translate(glob)
+            if pattern.endswith('\\Z(?ms)'):
+                pattern = pattern[:-len('\\Z(?ms)')]
+            patterns.append('(%s\\Z)' % pattern)
+        _glob_res.append((re.compile('|'.join(patterns), re.M | re.S), offset))
+
+def _match_ext(leaf):
+    """Returns the type of the longest extension of leaf in exts, or None."""
+    node = _ext_trie
+    found = None
+    if leaf.endswith('.'):
+        found = node.get(None)
+    i = len(leaf)
+    while i > 0:
+        node = node.get(leaf[i - 1])
+        if node is None:
+            break
+        i -= 1
+        if i > 0 and leaf[i - 1] == '.' and None in node:
+            found = node[None]
+    return found
+
+def _match_glob(leaf, lleaf):
+    """Returns the type of the first glob matching leaf or lleaf, or None."""
+    for regex, offset in _glob_res:
+        matches = [m.lastindex for m in (regex.match(leaf), regex.match(lleaf)) if m]
+        if matches:
+            return globs[offset + min(matches) - 1][1]
+    return None
+
 def get_type_by_name(path):
     """Returns type of file by its name, or None if not known"""
     if not _cache_uptodate:
@@ -365,26 +599,10 @@ def get_type_by_name(path):
     if lleaf in literals:
         return literals[lleaf]
 
-    ext = leaf
-    while 1:
-        p = ext.find('.')
-        if p < 0: break
-        ext = ext[p + 1:]
-        if ext in exts:
-            return exts[ext]
-    ext = lleaf
-    while 1:
-        p = ext.find('.')
-        if p < 0: break
-        ext = ext[p+1:]
-        if ext in exts:
-            return exts[ext]
-    for (glob, mime_type) in globs:
-        if fnmatch.fnmatch(leaf, glob):
-            return mime_type
-        if fnmatch.fnmatch(lleaf, glob):
-            return mime_type
-    return None
+    mime_type = _match_ext(leaf) or _match_ext(lleaf)
+    if mime_type:
+        return mime_type
+    return _match_glob(leaf, lleaf)
 
 def get_type_by_contents(path, max_pri=100, min_pri=0):
     """Returns type of file by its contents, or None if not known"""
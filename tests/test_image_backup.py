@@ -0,0 +1,136 @@
+"""End to end tests of image-backup, run against temporary source and destination trees"""
+
+import os
+import os.path as path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+SCRIPT = path.join(path.dirname(path.dirname(path.abspath(__file__))),"image-backup-1.9.py")
+
+def findPython():
+	"""Python 2 interpreter to run image-backup with, or None if there is none"""
+	if os.environ.get("IMAGEBACKUP_PYTHON"): return os.environ["IMAGEBACKUP_PYTHON"]
+	if sys.version_info[0] == 2: return sys.executable
+	devnull = open(os.devnull,"w")
+	try:
+		if subprocess.call(["python2","-c","pass"],stdout=devnull,stderr=devnull) == 0: return "python2"
+	except OSError:
+		pass
+	finally:
+		devnull.close()
+	return None
+
+PYTHON = findPython()
+
+@unittest.skipIf(PYTHON == None,"no Python 2 interpreter to run image-backup")
+class ImageBackupTest(unittest.TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp(prefix="imagebackup-test")
+		self.source = path.join(self.root,"src")
+		self.destination = path.join(self.root,"dst")
+		os.makedirs(self.source)
+		os.makedirs(self.destination)
+		self.env = dict(os.environ)
+		self.env["XDG_CACHE_HOME"] = path.join(self.root,"cache")
+		self.env["PYTHONDONTWRITEBYTECODE"] = "1"
+
+	def tearDown(self):
+		shutil.rmtree(self.root,True)
+
+	def backup(self,*args,**kwargs):
+		"""Runs image-backup with args and returns its output. Fails on a non-zero exit status"""
+		p = subprocess.Popen([PYTHON,SCRIPT]+list(args),stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,env=self.env)
+		output = p.communicate(kwargs.get("input","").encode())[0].decode("utf-8","replace")
+		if kwargs.get("check",True):
+			self.assertEqual(p.returncode,0,output)
+		return output
+
+	def snapshot(self,directory):
+		"""Names, sizes and modification times of everything below directory"""
+		entries = {}
+		for dirname,dirnames,filenames in os.walk(directory):
+			for name in dirnames+filenames:
+				st = os.lstat(path.join(dirname,name))
+				entries[path.relpath(path.join(dirname,name),directory)] = (st.st_size,st.st_mtime)
+		return entries
+
+	def writeSource(self,name,data):
+		filename = path.join(self.source,name)
+		if not path.isdir(path.dirname(filename)): os.makedirs(path.dirname(filename))
+		f = open(filename,"wb")
+		f.write(data)
+		f.close()
+
+	def testOnlyHashSkipsSwappedNames(self):
+		self.writeSource("20110101-a.jpg",b"first image")
+		self.writeSource("20110101-b.jpg",b"second image")
+		self.backup("-s",self.source,"--no-thumbnails",self.destination)
+		a = path.join(self.source,"20110101-a.jpg")
+		b = path.join(self.source,"20110101-b.jpg")
+		os.rename(a,a+".tmp")
+		os.rename(b,a)
+		os.rename(a+".tmp",b)
+		output = self.backup("-s",self.source,"--no-thumbnails","--only-hash",self.destination)
+		self.assertTrue("0 new, 0 modified, 2 renamed and 0 unchanged files" in output,output)
+		self.assertFalse("Modified:" in output,output)
+		self.assertTrue("Nothing to backup" in output,output)
+
+	def testLookupLeavesDestinationUnchanged(self):
+		self.writeSource("20110101-a.jpg",b"first image")
+		self.backup("-s",self.source,"--no-thumbnails",self.destination)
+		for name in os.listdir(self.destination):
+			if name.endswith(".idx") or name.endswith(".lock"): os.remove(path.join(self.destination,name))
+		before = self.snapshot(self.destination)
+		output = self.backup("--lookup",self.destination,path.join(self.source,"20110101-a.jpg"),"0"*32)
+		self.assertTrue("1 of 2 lookups found in catalog" in output,output)
+		self.assertEqual(self.snapshot(self.destination),before)
+
+	def testLookupWithoutCatalog(self):
+		output = self.backup("--lookup",self.destination,"0"*32,check=False)
+		self.assertTrue("No catalog found" in output,output)
+		self.assertEqual(os.listdir(self.destination),[])
+
+	def testFailedCopyRemovesPartFile(self):
+		self.writeSource("20110101-a.jpg",b"first image")
+		now = time.time()
+		for backupset in set([time.strftime("%Y%m%d-%H%M",time.localtime(now+offset)) for offset in (0,60)]):
+			os.makedirs(path.join(self.destination,backupset,"20110101-a.jpg","blocker"))
+		output = self.backup("-s",self.source,"--no-thumbnails",self.destination,input="y\ny\n",check=False)
+		self.assertTrue("File could not be copied" in output,output)
+		self.assertEqual([name for name in self.snapshot(self.destination) if name.endswith(".part")],[])
+
+	def testFailedCopyKeepsResumeFile(self):
+		self.writeSource("20110101-a.jpg",b"first image")
+		now = time.time()
+		blockers = [path.join(self.destination,time.strftime("%Y%m%d-%H%M",time.localtime(now+offset)),"20110101-a.jpg") for offset in (0,60)]
+		for blocker in set(blockers): os.makedirs(path.join(blocker,"blocker"))
+		resumeFile = path.join(self.destination,"backup.info.resume")
+		output = self.backup("-s",self.source,"--no-thumbnails",self.destination,input="y\ny\n",check=False)
+		self.assertTrue("1 files could not be copied" in output,output)
+		self.assertTrue(path.isfile(resumeFile),output)
+		for blocker in set(blockers): shutil.rmtree(blocker)
+		output = self.backup("-s",self.source,"--no-thumbnails",self.destination,input="\n")
+		self.assertTrue("Resuming backup set" in output,output)
+		self.assertFalse(path.exists(resumeFile),output)
+
+	def testStatisticsAgreeBetweenCatalogs(self):
+		for i in range(1,5):
+			self.writeSource("2011010%d-120000.jpg" % i,b"image %d" % i)
+		outputs = []
+		for catalog in ("text","sqlite"):
+			destination = path.join(self.root,catalog)
+			os.makedirs(destination)
+			self.backup("-s",self.source,"--no-thumbnails","--catalog",catalog,destination)
+			self.backup("-b","-r","2011:01:01-2011:01:03","-t",path.join(self.root,catalog+"-disc"),"--catalog",catalog,destination,input="Disc1\n")
+			for dirname,dirnames,filenames in os.walk(destination):
+				if "20110101-120000.jpg" in filenames: os.remove(path.join(dirname,"20110101-120000.jpg"))
+				if "20110103-120000.jpg" in filenames: os.remove(path.join(dirname,"20110103-120000.jpg"))
+			outputs.append(self.backup("--statistics","--catalog",catalog,destination))
+		self.assertTrue("contains 1 (0 mb) files locally and 2 (0 mb) files externally" in outputs[0],outputs[0])
+		self.assertEqual(outputs[0],outputs[1])
+
+if __name__ == "__main__": unittest.main()